@@ -0,0 +1,104 @@
+"""สร้างตารางผ่าตัดสังเคราะห์สำหรับ benchmark (ไม่มีข้อมูลผู้ป่วยจริง)
+
+ตัวอย่าง:
+    python bench/gen_schedule.py 100k schedule_100k.xlsx
+    python bench/gen_schedule.py 1m schedule_1m.parquet --other-rate 0.2 --days 5
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+# การสะกดที่พบจริงในคอลัมน์ icd9cm_name (ตัวพิมพ์/เว้นวรรค/เครื่องหมายปนกัน)
+KNOWN_SPELLINGS = [
+    "I&D abscess", "I & D abscess", "I/D", "i+d", "I and D", "incision and drainage", "Incision & Drainage abscess",
+    "Excision of lipoma", "excision mass", "Wide excision", "EXCISION", "incisional biopsy", "Incision biopsy",
+    "Nail extraction", "nail ext", "Nail extract",
+    "Off perm cath", "off TCC", "Off permanent catheter", "off cath",
+    "LN biopsy", "Lymph node biopsy", "lymphnode biopsy",
+    "Debridement", "debride wound", "excisional debridement", "D/B", "db",
+    "E.C.", "EC", "e. c.", "E C",
+    "Frenectomy", "frenulectomy",
+    "Morpheus", "morpheus 8", "Cooltech", "cool tech",
+    "Laser CO2", "laser",
+    "ptosis repair", "levator advancement", "Blepharoptosis repair", "frontalis sling",
+    "face lift", "Facelift", "rhytidectomy",
+]
+# สะกดผิด -> ไม่ตรง rules แต่ fuzzy matching จับได้
+TYPO_SPELLINGS = ["debridment", "exicision", "frenectmy", "nail extration", "morpheous", "face-lif", "lazer"]
+# หัตถการที่ไม่มีใน rules (ตกเป็น Other)
+OTHER_SPELLINGS = [
+    "wart removal", "cyst remove", "skin tag removal", "mole removal", "keloid injection",
+    "nevus removal", "steroid injection", "suture removal", "foreign body removal", "botox",
+]
+SITES = ["", "", "", " at back", " at L arm", " at R leg", " at face", " at scalp", " at neck", " at abdomen"]
+NOTES = [None, None, "L arm", "R leg", "LA", "GA", "ด่วน", "นัดต่อเนื่อง"]
+TIME_VALUES = [730, 800, 830, 900, 930, 1000, 1045.0, 1100, 1300, 1330, 1400, 1500, 1600]
+
+def parse_size(text: str) -> int:
+    """'1k' / '100k' / '1m' / '2500' -> จำนวนแถว"""
+    text = text.strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+def generate_schedule(n_rows: int, other_rate: float = 0.15, typo_rate: float = 0.03, days: int = 1,
+                      start_date: str = "2026-01-05", seed: int = 0) -> pd.DataFrame:
+    """ตารางผ่าตัดสังเคราะห์ n_rows แถว คอลัมน์เหมือนไฟล์จริง (รวมคอลัมน์ที่ dashboard ไม่อ่าน)"""
+    rng = np.random.default_rng(seed)
+    kind = rng.random(n_rows)
+    known = np.array(KNOWN_SPELLINGS, dtype=object)[rng.integers(0, len(KNOWN_SPELLINGS), n_rows)]
+    other = np.array(OTHER_SPELLINGS, dtype=object)[rng.integers(0, len(OTHER_SPELLINGS), n_rows)]
+    typo = np.array(TYPO_SPELLINGS, dtype=object)[rng.integers(0, len(TYPO_SPELLINGS), n_rows)]
+    proc = np.where(kind < other_rate, other, np.where(kind < other_rate + typo_rate, typo, known))
+    # ตำแหน่ง/ขนาด ทำให้มีข้อความไม่ซ้ำจำนวนมากเหมือนไฟล์จริง
+    sites = np.array(SITES, dtype=object)[rng.integers(0, len(SITES), n_rows)]
+    size_cm = rng.integers(1, 10, n_rows).astype(str).astype(object)
+    sizes = np.where(rng.random(n_rows) < 0.2, " " + size_cm + " cm", "")
+    proc = proc + sites + sizes
+    proc[rng.random(n_rows) < 0.005] = None
+
+    # เวลา: ตัวเลข HHMM / "HH:MM" / float / ว่าง / ข้อความที่แปลงไม่ได้ ปนกันในคอลัมน์เดียว
+    t = np.array(TIME_VALUES, dtype=object)[rng.integers(0, len(TIME_VALUES), n_rows)]
+    fmt = rng.random(n_rows)
+    times = t.copy()
+    as_text = fmt < 0.25
+    times[as_text] = [f"{int(v) // 100:02d}:{int(v) % 100:02d}" for v in t[as_text]]
+    times[(fmt >= 0.25) & (fmt < 0.35)] = None
+    times[(fmt >= 0.35) & (fmt < 0.37)] = "TF"
+
+    dates = pd.Timestamp(start_date) + pd.to_timedelta(rng.integers(0, max(days, 1), n_rows), unit="D")
+    return pd.DataFrame({
+        "hn": rng.integers(1_000_000, 9_999_999, n_rows),
+        "patient_name": "ผู้ป่วยสังเคราะห์",
+        "surgeon": np.array(["นพ. ก", "พญ. ข", "นพ. ค"], dtype=object)[rng.integers(0, 3, n_rows)],
+        "estmdate": dates,
+        "estmtime": times,
+        "icd9cm_name": proc,
+        "procnote": np.array(NOTES, dtype=object)[rng.integers(0, len(NOTES), n_rows)],
+    })
+
+def write_schedule(df: pd.DataFrame, path: str):
+    if path.endswith(".parquet"):
+        # เวลาเป็นชนิดปนกัน เก็บเป็นข้อความใน parquet
+        df.astype({"estmtime": "string"}).to_parquet(path, index=False)
+    elif path.endswith(".csv"):
+        df.to_csv(path, index=False)
+    else:
+        df.to_excel(path, index=False)
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="สร้างตารางผ่าตัดสังเคราะห์")
+    parser.add_argument("size", help="จำนวนแถว เช่น 1k, 100k, 1m")
+    parser.add_argument("out", help="ไฟล์ปลายทาง (.xlsx / .parquet / .csv)")
+    parser.add_argument("--other-rate", type=float, default=0.15)
+    parser.add_argument("--typo-rate", type=float, default=0.03)
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    df = generate_schedule(parse_size(args.size), args.other_rate, args.typo_rate, args.days, seed=args.seed)
+    write_schedule(df, args.out)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
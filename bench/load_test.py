@@ -0,0 +1,244 @@
+"""Load test ของ pro_db.py: จำลองหลาย session เปิดหน้าพร้อมกันแบบ headless (Streamlit AppTest)
+
+แต่ละ session สุ่มทำ rerun / ติ๊กเคสเสร็จแล้ว / รีเซ็ตสถานะ / อัปโหลดไฟล์ใหม่ บนตารางผ่าตัดสังเคราะห์
+แล้วรายงาน percentile ของเวลา rerun, การรอ/ลองใหม่ของ write lock ใน or_dashboard.db และหน่วยความจำต่อ session
+
+AppTest สลับ Runtime ของทั้ง process ทุกครั้งที่รัน script จึงรันได้ทีละ session ต่อ process
+session จึงกระจายไปหลาย process (--procs) ที่ใช้ DB / ไฟล์ shared ชุดเดียวกัน ให้ script และการเขียน DB
+ทำงานพร้อมกันจริง ภายใน process เดียวกัน session ต่อคิวกัน (queue_ms คือเวลารอคิวนั้น)
+
+ตัวอย่าง:
+    python bench/load_test.py                                    # 30 session x 20 action, 4 process, 400 เคส
+    python bench/load_test.py --sessions 60 --actions 50 --rows 2000 --procs 8
+    python bench/load_test.py --out load.json --p95-limit-ms 1500
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import or_core  # noqa: E402
+from gen_schedule import generate_schedule  # noqa: E402
+
+SCRIPT_PATH = os.path.join(REPO_DIR, "pro_db.py")
+SHARED_EXCEL_PATH = "shared_schedule.xlsx"  # เหมือน pro_db.py (path สัมพัทธ์กับโฟลเดอร์ทำงาน)
+ROOM_SCHEDULE_DIR = "room_schedules"
+UPLOAD_VARIANTS = 3  # จำนวนไฟล์ต่างกันที่ session สุ่มอัปโหลด
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# สัดส่วน action ของผู้ใช้หนึ่งคน: ส่วนใหญ่เปิดหน้าค้างไว้ (rerun), ติ๊กเคสเป็นระยะ, รีเซ็ต/อัปโหลดนานๆ ครั้ง
+ACTION_WEIGHTS = {"rerun": 0.62, "complete": 0.30, "reset": 0.05, "upload": 0.03}
+COMPLETE_BATCH = 3  # จำนวนเคสที่ติ๊กต่อการกดบันทึกหนึ่งครั้ง
+
+def rss_mb() -> float:
+    """หน่วยความจำ (RSS) ปัจจุบันของ process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        # ไม่มี /proc (macOS): ใช้ค่าสูงสุดแทน
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+def current_cases() -> tuple[np.ndarray, np.ndarray]:
+    """case key / วันที่ ของตารางที่ใช้อยู่ (ได้จาก cache เดียวกับที่ dashboard ใช้ ไม่ parse ซ้ำ)"""
+    sources = or_core.discover_sources(SHARED_EXCEL_PATH, ROOM_SCHEDULE_DIR)
+    rules_version = or_core.get_rules().version
+    parts = or_core.load_sources(sources, rules_version)
+    df_work, _ = or_core.combine_schedules(or_core.schedules_version(sources), rules_version, parts)
+    return df_work["__case_key__"].to_numpy(), df_work["__op_date__"].astype(str).to_numpy()
+
+class Session:
+    """ผู้ใช้หนึ่งคน = AppTest หนึ่งตัว (session_state แยกกัน, cache ระดับ process ใช้ร่วมกัน)"""
+
+    def __init__(self, sid: int, seed: int, timeout: float, uploads: list[tuple[str, bytes]], run_lock: threading.Lock):
+        from streamlit.testing.v1 import AppTest
+
+        self.sid = sid
+        self.at = AppTest.from_file(SCRIPT_PATH, default_timeout=timeout)
+        self.at.session_state["authenticated"] = True
+        self.uploads = uploads
+        self.run_lock = run_lock
+        self.rng = np.random.default_rng([seed, sid])
+        self.samples: list[tuple[str, float, float]] = []  # (action, วินาทีทั้งหมด, วินาทีที่รอคิว)
+        self.errors: list[str] = []
+        self._queued = 0.0
+
+    def _run(self, element=None):
+        t0 = time.perf_counter()
+        with self.run_lock:
+            self._queued += time.perf_counter() - t0
+            (element or self.at).run()
+
+    def rerun(self):
+        self._run()
+
+    def complete(self):
+        # AppTest ยังกรอก st.data_editor ไม่ได้: ทำแบบเดียวกับตอนกด "บันทึกสถานะ" (เขียน DB แล้ว rerun)
+        keys, dates = current_cases()
+        pick = self.rng.choice(len(keys), size=min(COMPLETE_BATCH, len(keys)), replace=False)
+        or_core.mark_completed_many(keys[pick], dates[pick])
+        self._run()
+
+    def reset(self):
+        self._run(self.at.button(key="reset_completed_safe").click())
+
+    def upload(self):
+        name, data = self.uploads[int(self.rng.integers(len(self.uploads)))]
+        self._run(self.at.sidebar.file_uploader[0].set_value((name, data, XLSX_MIME)))
+
+    def step(self, action: str):
+        self._queued = 0.0
+        t0 = time.perf_counter()
+        try:
+            getattr(self, action)()
+            self.errors += [f"{action}: {e.value}" for e in self.at.exception]
+        except Exception as e:
+            self.errors.append(f"{action}: {type(e).__name__}: {e}")
+        self.samples.append((action, time.perf_counter() - t0, self._queued))
+
+    def run_actions(self, n_actions: int, think_seconds: float):
+        actions, weights = list(ACTION_WEIGHTS), np.array(list(ACTION_WEIGHTS.values()))
+        for action in self.rng.choice(actions, size=n_actions, p=weights / weights.sum()):
+            if think_seconds:
+                time.sleep(float(self.rng.uniform(0, 2 * think_seconds)))
+            self.step(str(action))
+
+def worker(session_ids: list[int], config: dict, workdir: str, start: mp.Barrier, results: mp.Queue):
+    """process หนึ่งที่ถือหลาย session (รันใน process ลูก)"""
+    os.chdir(workdir)
+    uploads = []
+    for i in range(UPLOAD_VARIANTS):
+        with open(f"upload_{i}.xlsx", "rb") as f:
+            uploads.append((f"upload_{i}.xlsx", f.read()))
+    run_lock = threading.Lock()
+    sessions = [Session(sid, config["seed"], config["timeout"], uploads, run_lock) for sid in session_ids]
+    # session แรกอุ่น cache ของ process (parse/enrich/archive) แยกหน่วยความจำที่ใช้ร่วมกันออกจากต่อ session
+    sessions[0].step("rerun")
+    rss_shared = rss_mb()
+    for session in sessions[1:]:
+        session.step("rerun")
+    for session in sessions:
+        session.samples.clear()
+    rss_open = rss_mb()
+    db = or_core.get_db()
+    lock_before = db.lock_stats()
+    start.wait()
+    threads = [
+        threading.Thread(target=s.run_actions, args=(config["actions"], config["think"]), name=f"session-{s.sid}")
+        for s in sessions
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    lock_after = db.lock_stats()
+    results.put({
+        "samples": [sample for s in sessions for sample in s.samples],
+        "errors": [f"session {s.sid} {e}" for s in sessions for e in s.errors],
+        "sqlite_lock": {k: lock_after[k] - lock_before[k] for k in lock_after},
+        "sessions": len(sessions),
+        "rss_shared_mb": rss_shared,
+        "rss_open_mb": rss_open,
+        "rss_end_mb": rss_mb(),
+    })
+
+def latency_report(samples: list[tuple[str, float, float]]) -> pd.DataFrame:
+    df = pd.DataFrame(samples, columns=["action", "seconds", "queued"])
+    rows = []
+    for action, g in [("all", df)] + list(df.groupby("action")):
+        ms = g["seconds"].to_numpy() * 1e3
+        p50, p90, p95, p99 = np.percentile(ms, [50, 90, 95, 99])
+        rows.append({"action": action, "count": len(ms), "p50_ms": p50, "p90_ms": p90, "p95_ms": p95,
+                     "p99_ms": p99, "max_ms": ms.max(), "queue_ms": g["queued"].mean() * 1e3})
+    return pd.DataFrame(rows).round(1)
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test หลาย session พร้อมกันของ OR-minor dashboard")
+    parser.add_argument("--sessions", type=int, default=30, help="จำนวน session (เช่นจำนวน ward ที่เปิดหน้าค้างไว้)")
+    parser.add_argument("--actions", type=int, default=20, help="จำนวน action ต่อ session หลังเปิดหน้า")
+    parser.add_argument("--procs", type=int, default=min(4, os.cpu_count() or 1), help="จำนวน process ที่ถือ session")
+    parser.add_argument("--rows", type=int, default=400, help="จำนวนเคสในตารางสังเคราะห์")
+    parser.add_argument("--think", type=float, default=0.0, help="เวลาคิดเฉลี่ยระหว่าง action (วินาที)")
+    parser.add_argument("--timeout", type=float, default=120, help="timeout ต่อการรัน script หนึ่งครั้ง (วินาที)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="เขียนผลเป็น JSON")
+    parser.add_argument("--p95-limit-ms", type=float, help="คืน exit code 1 ถ้า p95 ของทุก action เกินค่านี้")
+    args = parser.parse_args(argv)
+
+    # ทำงานในโฟลเดอร์ชั่วคราว: DB / sidecar / ไฟล์ shared ไม่ปนกับของจริง
+    tmp = tempfile.TemporaryDirectory()
+    today = date.today().isoformat()
+    generate_schedule(args.rows, start_date=today, seed=args.seed).to_excel(
+        os.path.join(tmp.name, SHARED_EXCEL_PATH), index=False
+    )
+    for i in range(UPLOAD_VARIANTS):
+        df = generate_schedule(args.rows, start_date=today, seed=args.seed + 1 + i)
+        df.to_excel(os.path.join(tmp.name, f"upload_{i}.xlsx"), index=False)
+
+    n_procs = max(1, min(args.procs, args.sessions))
+    groups = [list(range(p, args.sessions, n_procs)) for p in range(n_procs)]
+    # spawn: process ลูกเริ่มใหม่ ไม่รับ connection SQLite / thread ของ process แม่ติดไปด้วย
+    ctx = mp.get_context("spawn")
+    start, results = ctx.Barrier(n_procs + 1), ctx.Queue()
+    config = {"actions": args.actions, "think": args.think, "timeout": args.timeout, "seed": args.seed}
+    procs = [ctx.Process(target=worker, args=(g, config, tmp.name, start, results)) for g in groups]
+    for p in procs:
+        p.start()
+    start.wait()
+    t0 = time.perf_counter()
+    parts = [results.get() for _ in procs]
+    wall = time.perf_counter() - t0
+    for p in procs:
+        p.join()
+
+    samples = [tuple(s) for part in parts for s in part["samples"]]
+    errors = [e for part in parts for e in part["errors"]]
+    lock = {k: sum(part["sqlite_lock"][k] for part in parts) for k in parts[0]["sqlite_lock"]}
+    lock["wait_seconds"] = round(lock["wait_seconds"], 4)
+    memory = {
+        "rss_shared_mb": round(float(np.mean([part["rss_shared_mb"] for part in parts])), 1),
+        "rss_end_mb": round(float(np.mean([part["rss_end_mb"] for part in parts])), 1),
+        # หน่วยความจำที่เพิ่มต่อ session ที่เปิดหน้าเพิ่ม (หลัง process มี cache ร่วมแล้ว)
+        "per_session_mb": round(float(np.mean([
+            (part["rss_open_mb"] - part["rss_shared_mb"]) / max(part["sessions"] - 1, 1) for part in parts
+        ])), 2),
+        "growth_during_run_mb": round(float(np.mean([part["rss_end_mb"] - part["rss_open_mb"] for part in parts])), 1),
+    }
+    report = latency_report(samples)
+    print(report.to_string(index=False))
+    print(f"\n{args.sessions} session ใน {n_procs} process, {len(samples)} action ใน {wall:.1f} วินาที "
+          f"({len(samples) / wall:.1f} action/วินาที)")
+    print("SQLite write lock: " + ", ".join(f"{k}={v}" for k, v in lock.items()))
+    print("หน่วยความจำ (เฉลี่ยต่อ process): " + ", ".join(f"{k}={v}" for k, v in memory.items()))
+    if errors:
+        print(f"\nผิดพลาด {len(errors)} ครั้ง:", *errors[:10], sep="\n  ", file=sys.stderr)
+
+    if args.out:
+        result = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "config": {k: v for k, v in vars(args).items() if k != "out"},
+            "wall_s": round(wall, 3),
+            "latency": report.to_dict(orient="records"),
+            "sqlite_lock": lock,
+            "memory": memory,
+            "errors": errors,
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    over_limit = args.p95_limit_ms is not None and float(report.loc[0, "p95_ms"]) > args.p95_limit_ms
+    return 1 if errors or lock["failures"] or over_limit else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
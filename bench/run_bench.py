@@ -0,0 +1,150 @@
+"""Benchmark ของ hot path ใน or_core เทียบกับ baseline ที่เก็บไว้
+
+ตัวอย่าง:
+    python bench/run_bench.py                                # 1k,100k,1m เทียบกับ bench/baseline.json
+    python bench/run_bench.py --sizes 1k,100k --repeat 3     # รอบเร็ว
+    python bench/run_bench.py --save-baseline                # บันทึกผลเป็น baseline ใหม่
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import or_core  # noqa: E402
+from gen_schedule import generate_schedule, parse_size  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+REGRESSION_THRESHOLD = 1.25  # ช้ากว่า baseline เกินกี่เท่าจึงนับว่า regression
+
+def measure(fn, setup=None, repeat: int = 5) -> dict:
+    """เวลาของ fn(state) repeat ครั้ง (setup ไม่นับเวลา) คืน median/min เป็นวินาที"""
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        t0 = time.perf_counter()
+        fn(state)
+        times.append(time.perf_counter() - t0)
+    return {"median_s": statistics.median(times), "min_s": min(times), "repeat": repeat}
+
+def reset_classification_cache():
+    """ล้าง classification cache ทั้งใน process และใน DB (ให้ classify แบบ cold)"""
+    with or_core.get_db().transaction() as conn:
+        conn.execute("DELETE FROM proc_classification_cache")
+    or_core.get_classification_cache.clear()
+
+def bench_size(n_rows: int, repeat: int) -> dict[str, dict]:
+    df_raw = generate_schedule(n_rows)
+    texts = df_raw["icd9cm_name"].tolist()
+    rules = or_core.get_rules()
+    results = {}
+
+    def run(name, fn, setup=None):
+        results[name] = measure(fn, setup, repeat)
+        print(f"  {name:<32} {results[name]['median_s'] * 1e3:10.2f} ms", file=sys.stderr)
+
+    run("normalize_proc_text", lambda _: [or_core.normalize_proc_text(x, rules) for x in texts])
+    run("classify_proc_category_rules", lambda _: [or_core.classify_proc_category_rules(x, rules) for x in texts])
+    run("classify_series_cold", lambda _: or_core.classify_series(df_raw["icd9cm_name"], rules), reset_classification_cache)
+    run("classify_series_warm", lambda _: or_core.classify_series(df_raw["icd9cm_name"], rules))
+    run("enrich_schedule", lambda _: or_core.enrich_schedule(df_raw))
+
+    df_work, meta = or_core.enrich_schedule(df_raw)
+    other_norms = list(pd.unique(df_work.loc[df_work["__proc_category__"] == "Other", "__norm__"].astype(str)))
+    if or_core._load_rapidfuzz() is not None:
+        run("fuzzy_best_matches", lambda cache: cache.best_matches(other_norms, rules), or_core.FuzzyScoreCache)
+    run("build_daily_summary", lambda _: or_core.build_daily_summary(df_work, meta))
+    run("top_unknowns", lambda _: or_core.top_unknowns(df_work, n=25))
+
+    case_keys = df_work["__case_key__"].to_numpy()
+    op_dates = df_work["__op_date__"].astype(str).to_numpy()
+
+    def clear_completions():
+        with or_core.get_db().transaction() as conn:
+            conn.execute("DELETE FROM case_completions")
+
+    def mark_all():
+        clear_completions()
+        or_core.mark_completed_many(case_keys, op_dates)
+
+    run("sqlite_mark_completed_many", lambda _: or_core.mark_completed_many(case_keys, op_dates), clear_completions)
+    run("sqlite_load_completions", lambda _: or_core.load_completions(sorted(set(op_dates))), mark_all)
+    run("sqlite_completion_sync", lambda _: or_core.CompletionState(case_keys, op_dates).sync(), mark_all)
+    run("sqlite_unmark_completed_many", lambda _: or_core.unmark_completed_many(case_keys), mark_all)
+    return results
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+def compare(current: dict, baseline: dict, threshold: float) -> tuple[pd.DataFrame, int]:
+    rows = []
+    for key, res in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        ratio = res["median_s"] / base["median_s"] if base and base["median_s"] > 0 else None
+        status = "new" if ratio is None else "SLOWER" if ratio > threshold else "faster" if ratio < 1 / threshold else "ok"
+        rows.append({
+            "benchmark": key,
+            "baseline_ms": round(base["median_s"] * 1e3, 3) if base else None,
+            "current_ms": round(res["median_s"] * 1e3, 3),
+            "ratio": round(ratio, 2) if ratio is not None else None,
+            "status": status,
+        })
+    report = pd.DataFrame(rows)
+    return report, int((report["status"] == "SLOWER").sum())
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark hot path ของ OR-minor dashboard")
+    parser.add_argument("--sizes", default="1k,100k,1m", help="ขนาดข้อมูล คั่นด้วย , (เช่น 1k,100k,1m)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="เขียนผลครั้งนี้ทับ baseline")
+    parser.add_argument("--out", help="เขียนผลครั้งนี้เป็น JSON")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    # ใช้ DB ชั่วคราว ไม่แตะ or_dashboard.db จริง
+    tmp = tempfile.TemporaryDirectory()
+    or_core.DB_PATH = os.path.join(tmp.name, "bench.db")
+    current = {"created_at": datetime.now().isoformat(timespec="seconds"), "environment": environment(), "results": {}}
+    for size in args.sizes.split(","):
+        n_rows = parse_size(size)
+        print(f"[{size}] {n_rows} rows", file=sys.stderr)
+        for name, res in bench_size(n_rows, args.repeat).items():
+            current["results"][f"{name}@{size.strip().lower()}"] = res
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+    regressions = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != current["environment"]:
+            print("หมายเหตุ: baseline มาจากเครื่อง/เวอร์ชันต่างกัน เทียบได้คร่าวๆ เท่านั้น", file=sys.stderr)
+        report, regressions = compare(current, baseline, args.threshold)
+        print(report.to_string(index=False))
+    else:
+        report, _ = compare(current, {}, args.threshold)
+        print(report.drop(columns=["baseline_ms", "ratio", "status"]).to_string(index=False))
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""เวลา cold start ของ dashboard: ทุกรอบเปิด Python process ใหม่ (เหมือน restart server) แล้ววัด
+
+- login: รัน pro_db.py ครั้งแรกของ process ด้วย session ที่ยังไม่เข้าสู่ระบบ
+- dashboard: รันครั้งถัดไปหลังเข้าสู่ระบบ (sidecar / DB มีอยู่แล้วจากรอบอุ่นเครื่อง)
+และรายชื่อ module หนักที่ถูก import แล้วหลังแต่ละขั้น
+
+ตัวอย่าง:
+    python bench/startup_time.py
+    python bench/startup_time.py --repeat 9 --rows 2000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+from gen_schedule import generate_schedule  # noqa: E402
+
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "or_core", "openpyxl", "xlrd", "rapidfuzz"]
+
+# รันใน process ใหม่ (cwd = โฟลเดอร์ทำงาน) พิมพ์ผลเป็น JSON บรรทัดเดียว
+CHILD = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+heavy = {heavy!r}
+loaded = lambda: [m for m in heavy if m in sys.modules]
+at = AppTest.from_file({script!r}, default_timeout=120)
+t0 = time.perf_counter()
+at.run()
+login_s = time.perf_counter() - t0
+after_login = loaded()
+at.session_state["authenticated"] = True
+t0 = time.perf_counter()
+at.run()
+dashboard_s = time.perf_counter() - t0
+print(json.dumps({{
+    "login_s": login_s, "dashboard_s": dashboard_s, "after_login": after_login, "after_dashboard": loaded(),
+    "errors": [e.value for e in at.exception],
+}}))
+"""
+
+def run_child(workdir: str) -> dict:
+    code = CHILD.format(heavy=HEAVY_MODULES, script=os.path.join(REPO_DIR, "pro_db.py"))
+    proc = subprocess.run([sys.executable, "-c", code], cwd=workdir, capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="วัดเวลา cold start ของ OR-minor dashboard")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=400, help="จำนวนเคสในตารางสังเคราะห์")
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory()
+    generate_schedule(args.rows).to_excel(os.path.join(tmp.name, "shared_schedule.xlsx"), index=False)
+    warm = run_child(tmp.name)  # สร้าง sidecar / DB / คลัง ไม่นับเวลา
+    if warm["errors"]:
+        print("dashboard error:", *warm["errors"], sep="\n  ", file=sys.stderr)
+        return 1
+    runs = [run_child(tmp.name) for _ in range(args.repeat)]
+    rows = []
+    for stage in ("login", "dashboard"):
+        times = [r[f"{stage}_s"] * 1e3 for r in runs]
+        rows.append({
+            "stage": stage,
+            "median_ms": round(statistics.median(times), 1),
+            "min_ms": round(min(times), 1),
+            "max_ms": round(max(times), 1),
+            "heavy_modules_loaded": ", ".join(runs[-1][f"after_{stage}"]) or "-",
+        })
+    print(pd.DataFrame(rows).to_string(index=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""ประมวลผลไฟล์ตารางผ่าตัดย้อนหลังทั้งโฟลเดอร์แบบขนาน (ไม่ต้องเปิด dashboard)
+
+ตัวอย่าง:
+    python or_batch.py /data/schedules --out reports --workers 8 --archive
+"""
+import argparse
+import datetime as dt
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import or_core
+
+WORKBOOK_PATTERNS = ("*.xlsx", "*.xls")
+RESULT_COLUMNS = ["__op_date__", "__case_key__", "__norm__", "__proc_category__", "__shift__", "__mins__"]
+
+def _init_worker(db_path: str):
+    # classification cache ใน DB ใช้ร่วมกันทุก worker (ค่าที่ classify แล้วไม่ต้องทำซ้ำ)
+    or_core.DB_PATH = db_path
+
+def find_workbooks(directory: str, recursive: bool = False) -> list[str]:
+    paths = set()
+    for pattern in WORKBOOK_PATTERNS:
+        sub = os.path.join("**", pattern) if recursive else pattern
+        paths.update(glob.glob(os.path.join(directory, sub), recursive=recursive))
+    # ไฟล์ชั่วคราวของ Excel (~$...) ไม่ใช่ตารางผ่าตัด
+    return sorted(p for p in paths if not os.path.basename(p).startswith("~$"))
+
+def concat_frames(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    if len(frames) == 1:
+        return frames[0]
+    df = pd.concat(frames, ignore_index=True)
+    # categorical ที่ categories ต่างกันเป็น object หลัง concat -> แปลงกลับ
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col].dtype):
+            df[col] = df[col].astype("category")
+    return df
+
+def process_workbook(path: str) -> dict:
+    """อ่าน + enrich ไฟล์เดียวทุก sheet (รันใน worker process) คืนเฉพาะคอลัมน์ที่ต้องใช้รวมผล
+
+    แต่ละ sheet คือหนึ่งห้องเหมือนใน dashboard (case key แยกตามห้อง, คลังบันทึกแยกห้อง)
+    """
+    t0 = time.perf_counter()
+    stat = os.stat(path)
+    fallback_date = dt.date.fromtimestamp(stat.st_mtime).isoformat()
+    sheets, metas = [], []
+    for sheet, df_raw in or_core.read_schedule_workbook(path).items():
+        df_work, meta = or_core.enrich_schedule(df_raw, fallback_date=fallback_date, scope=sheet)
+        keep = ([meta["proc_col_used"]] if meta["proc_col_used"] else []) + RESULT_COLUMNS
+        sheets.append({"sheet": sheet, "room": sheet or "", "frame": df_work[keep]})
+        metas.append(meta)
+    meta = {
+        "proc_col_used": next((m["proc_col_used"] for m in metas if m["proc_col_used"]), None),
+        "cases_total": sum(m["cases_total"] for m in metas),
+    }
+    return {
+        "path": path,
+        "mtime": stat.st_mtime,
+        "content_hash": or_core.file_content_hash(path),
+        "frame": concat_frames([s["frame"] for s in sheets]),
+        "sheets": sheets,
+        "meta": meta,
+        "seconds": time.perf_counter() - t0,
+    }
+
+def latest_per_date(results: list[dict]) -> list[dict]:
+    """วันเดียวกันที่มีหลายไฟล์ (อัปโหลดซ้ำ) ใช้ไฟล์ที่ใหม่ที่สุด เหมือนคลังใน dashboard"""
+    owner: dict[str, int] = {}
+    for i, res in sorted(enumerate(results), key=lambda x: x[1]["mtime"]):
+        for op_date in res["frame"]["__op_date__"].cat.categories:
+            owner[str(op_date)] = i
+    out = []
+    for i, res in enumerate(results):
+        dates = [d for d, j in owner.items() if j == i]
+        if dates:
+            frame = res["frame"]
+            out.append({**res, "frame": frame[frame["__op_date__"].astype(str).isin(dates)]})
+    return out
+
+def combined_reports(results: list[dict], top_n: int = 200) -> dict[str, pd.DataFrame]:
+    frames = [res["frame"] for res in latest_per_date(results)]
+    rollup = pd.concat([or_core.daily_rollup(f) for f in frames], ignore_index=True)
+    rollup = rollup.astype({"__op_date__": str, "__shift__": str, "__proc_category__": str})
+    categories = [c for c in or_core.get_rules().categories if c in set(rollup["__proc_category__"])]
+
+    def pivot(index: list[str]) -> pd.DataFrame:
+        table = rollup.pivot_table(index=index, columns="__proc_category__", values="n", aggfunc="sum", fill_value=0)
+        table = table.reindex(columns=categories, fill_value=0)
+        table["Total"] = table.sum(axis=1)
+        table.columns.name = None
+        return table.reset_index()
+
+    daily = pivot(["__op_date__", "__shift__"]).rename(columns={"__op_date__": "op_date", "__shift__": "shift"})
+    daily["shift"] = daily["shift"].map(or_core.SHIFT_LABEL_MAP)
+    rollup["month"] = rollup["__op_date__"].str[:7]
+    monthly = pivot(["month"])
+    unknown = pd.concat([or_core.top_unknowns(f, n=len(f)) for f in frames], ignore_index=True)
+    unknown = unknown.groupby("normalized_proc", as_index=False)["count"].sum()
+    unknown = unknown.sort_values("count", ascending=False, kind="stable").head(top_n)
+    return {"daily_summary": daily, "monthly_summary": monthly, "unknown_procedures": unknown}
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="สรุปตารางผ่าตัด OR-minor ย้อนหลังจากโฟลเดอร์ไฟล์ Excel")
+    parser.add_argument("directory", help="โฟลเดอร์ที่มีไฟล์ .xlsx/.xls")
+    parser.add_argument("--out", default="or_reports", help="โฟลเดอร์ที่เขียนรายงาน CSV")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="จำนวน process")
+    parser.add_argument("--recursive", action="store_true", help="ค้นหาไฟล์ในโฟลเดอร์ย่อยด้วย")
+    parser.add_argument("--top", type=int, default=200, help="จำนวน procedure ที่เป็น Other สูงสุดในรายงาน")
+    parser.add_argument("--db", default=or_core.DB_PATH, help="SQLite ของ dashboard (classification cache / คลัง)")
+    parser.add_argument("--archive", action="store_true", help="บันทึกลงคลังย้อนหลังของ dashboard ด้วย")
+    args = parser.parse_args(argv)
+
+    paths = find_workbooks(args.directory, recursive=args.recursive)
+    if not paths:
+        print(f"ไม่พบไฟล์ Excel ใน {args.directory}", file=sys.stderr)
+        return 1
+    _init_worker(args.db)
+    t0 = time.perf_counter()
+    results, failures = [], []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(args.db,)) as pool:
+        futures = {pool.submit(process_workbook, p): p for p in paths}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            path = futures[fut]
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                failures.append({"path": path, "error": f"{type(e).__name__}: {e}"})
+            print(f"[{done}/{len(paths)}] {os.path.basename(path)}", file=sys.stderr)
+
+    os.makedirs(args.out, exist_ok=True)
+    files = pd.DataFrame(
+        [{"path": r["path"], "cases": r["meta"]["cases_total"], "seconds": round(r["seconds"], 3), "error": ""}
+         for r in results] + [{**f, "cases": 0, "seconds": None} for f in failures]
+    )
+    files.to_csv(os.path.join(args.out, "files.csv"), index=False, encoding="utf-8-sig")
+    if results:
+        for name, report in combined_reports(results, top_n=args.top).items():
+            report.to_csv(os.path.join(args.out, f"{name}.csv"), index=False, encoding="utf-8-sig")
+    if args.archive:
+        rules_version = or_core.get_rules().version
+        # เขียนจาก process หลักทีละไฟล์ (SQLite มีผู้เขียนได้ครั้งละหนึ่ง) เก่า -> ใหม่ ให้ไฟล์ใหม่ทับวันเดียวกัน
+        for res in sorted(results, key=lambda r: r["mtime"]):
+            name = os.path.basename(res["path"])
+            for part in res["sheets"]:
+                label = name + (f" [{part['sheet']}]" if part["sheet"] else "")
+                or_core.archive_schedule(
+                    part["frame"], or_core.source_version(res["content_hash"], part["sheet"]), rules_version, label,
+                    room=part["room"],
+                )
+    print(
+        f"ประมวลผล {len(results)} ไฟล์ ({sum(r['meta']['cases_total'] for r in results)} เคส), "
+        f"ไม่สำเร็จ {len(failures)} ไฟล์ ใน {time.perf_counter() - t0:.1f} วินาที -> {args.out}",
+        file=sys.stderr,
+    )
+    return 0 if not failures else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1791 @@
+"""แกนประมวลผลตารางผ่าตัด OR-minor (ไม่ขึ้นกับ Streamlit)
+
+ใช้ได้ทั้งจาก dashboard (pro_db.py) และ batch CLI (or_batch.py); cache ต่างๆ เป็น singleton ต่อ process
+"""
+import pandas as pd
+import numpy as np
+import datetime as dt
+import re
+import sqlite3
+import os
+import hashlib
+import html
+import io
+import inspect
+import json
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import NamedTuple
+
+# ===============================
+# PROCESS CACHE (แทน st.cache_resource)
+# ===============================
+def process_cache(max_entries: int | None = None):
+    """เก็บผลของฟังก์ชันไว้ต่อ process (LRU ตาม max_entries) และคำนวณครั้งเดียวต่อ key แม้เรียกพร้อมกันหลาย thread
+
+    argument ที่ชื่อขึ้นต้นด้วย _ ไม่อยู่ใน key (เหมือน st.cache_resource) ผลที่ได้ใช้ร่วมกันห้ามแก้
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+        entries: OrderedDict = OrderedDict()
+        key_locks: dict[tuple, threading.Lock] = {}
+        lock = threading.Lock()
+        counts = {"hits": 0, "misses": 0}
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = tuple((k, v) for k, v in bound.arguments.items() if not k.startswith("_"))
+            with lock:
+                if key in entries:
+                    entries.move_to_end(key)
+                    counts["hits"] += 1
+                    return entries[key]
+                key_lock = key_locks.setdefault(key, threading.Lock())
+            with key_lock:
+                with lock:
+                    if key in entries:
+                        counts["hits"] += 1
+                        return entries[key]
+                    counts["misses"] += 1
+                try:
+                    value = func(*args, **kwargs)
+                except BaseException:
+                    with lock:
+                        key_locks.pop(key, None)
+                    raise
+                # เก็บผลและปลด key lock ใน lock เดียวกัน: thread ที่มาทีหลังเห็นผลเสมอ ไม่คำนวณซ้ำ
+                with lock:
+                    entries[key] = value
+                    key_locks.pop(key, None)
+                    while max_entries and len(entries) > max_entries:
+                        entries.popitem(last=False)
+            return value
+
+        def clear():
+            with lock:
+                entries.clear()
+
+        def stats() -> dict:
+            total = counts["hits"] + counts["misses"]
+            return {**counts, "hit_rate": (counts["hits"] / total) if total else 0.0, "entries": len(entries)}
+
+        wrapper.clear = clear
+        wrapper.stats = stats
+        return wrapper
+    return decorator
+
+# ===============================
+# TIMING (ring buffer ของเวลาแต่ละ stage ทั้ง process)
+# ===============================
+TIMING_BUFFER_SIZE = 5000  # จำนวน span ล่าสุดที่เก็บไว้คิด p50/p95
+PROMETHEUS_WRITE_INTERVAL = 15  # วินาทีขั้นต่ำระหว่างการเขียนไฟล์ metrics
+
+class StageTimings:
+    """เวลาของแต่ละ stage (วินาที) ใน deque ขนาดคงที่ ใช้ร่วมกันทุก thread; span เก่าหลุดออกเอง"""
+
+    def __init__(self, maxlen: int = TIMING_BUFFER_SIZE):
+        self._samples: deque[tuple[str, float]] = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._last_export = 0.0
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.append((stage, seconds))
+
+    @contextmanager
+    def span(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - t0)
+
+    def summary(self, decimals: int | None = 3) -> pd.DataFrame:
+        """count / p50 / p95 / max (ms) ต่อ stage จาก span ที่อยู่ใน buffer"""
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return pd.DataFrame(columns=["stage", "count", "p50_ms", "p95_ms", "max_ms", "total_s"])
+        df = pd.DataFrame(samples, columns=["stage", "seconds"])
+        g = df.groupby("stage")["seconds"]
+        out = pd.DataFrame({
+            "count": g.size(),
+            "p50_ms": g.quantile(0.5) * 1e3,
+            "p95_ms": g.quantile(0.95) * 1e3,
+            "max_ms": g.max() * 1e3,
+            "total_s": g.sum(),
+        })
+        if decimals is not None:
+            out = out.round(decimals)
+        return out.sort_values("total_s", ascending=False).reset_index()
+
+    def prometheus_text(self, cache_stats: dict[str, dict] | None = None) -> str:
+        """metrics แบบ Prometheus text exposition (summary ต่อ stage + cache hit ratio)"""
+        lines = [
+            "# HELP or_dashboard_stage_seconds Stage duration over the recent ring buffer window.",
+            "# TYPE or_dashboard_stage_seconds summary",
+        ]
+        summary = self.summary(decimals=None)
+        for row in summary.itertuples():
+            label = f'stage="{row.stage}"'
+            lines.append(f'or_dashboard_stage_seconds{{{label},quantile="0.5"}} {row.p50_ms / 1e3:.6f}')
+            lines.append(f'or_dashboard_stage_seconds{{{label},quantile="0.95"}} {row.p95_ms / 1e3:.6f}')
+            lines.append(f"or_dashboard_stage_seconds_sum{{{label}}} {row.total_s:.6f}")
+            lines.append(f"or_dashboard_stage_seconds_count{{{label}}} {row.count}")
+        if cache_stats:
+            lines.append("# HELP or_dashboard_cache_hit_ratio Cache hit ratio since process start.")
+            lines.append("# TYPE or_dashboard_cache_hit_ratio gauge")
+            for name, stats in cache_stats.items():
+                lines.append(f'or_dashboard_cache_hit_ratio{{cache="{name}"}} {stats["hit_rate"]:.4f}')
+        return "\n".join(lines) + "\n"
+
+    def export_prometheus(self, path: str, cache_stats: dict[str, dict] | None = None, force: bool = False) -> bool:
+        """เขียนไฟล์ metrics (สำหรับ node_exporter textfile collector) ไม่บ่อยกว่า PROMETHEUS_WRITE_INTERVAL"""
+        now = time.monotonic()
+        if not force and now - self._last_export < PROMETHEUS_WRITE_INTERVAL:
+            return False
+        self._last_export = now
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text(cache_stats))
+        os.replace(tmp, path)
+        return True
+
+@process_cache()
+def get_timings() -> StageTimings:
+    return StageTimings()
+
+def cache_stats() -> dict[str, dict]:
+    """hit rate ของ cache หลักทั้ง process (classification/fuzzy ต่อ string, ที่เหลือต่อการเรียก)"""
+    return {
+        "classification": get_classification_cache().stats(),
+        "fuzzy": get_fuzzy_cache().stats(),
+        "schedule": get_schedule.stats(),
+        "completion_state": get_completion_state.stats(),
+        "file_hash": _file_content_hash.stats(),
+        "export": get_export_manager().stats(),
+    }
+
+def timed(stage: str):
+    """decorator: จับเวลาทุกครั้งที่เรียกฟังก์ชันเป็น span ชื่อ stage"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_timings().span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ===============================
+# SHARED EXCEL + SQLITE SETUP
+# ===============================
+DB_PATH = "or_dashboard.db"
+SIDECAR_DIR = ".schedule_cache"  # sidecar แบบ columnar ของไฟล์ Excel (key ด้วย hash เนื้อหาไฟล์)
+SIDECAR_KEEP = 30  # ต่อ sheet/ห้อง หนึ่งไฟล์ที่มีหลาย sheet ใช้หลาย sidecar
+SIDECAR_FORMAT = "v2"  # เปลี่ยนเมื่อรูปแบบข้อมูลใน sidecar เปลี่ยน (v2 = เก็บเฉพาะคอลัมน์ที่ใช้)
+CLASSIFICATION_CACHE_MAX = 20000  # จำนวน procedure string สูงสุดที่เก็บใน LRU
+THROUGHPUT_WINDOW_MINUTES = 60  # ช่วงเวลาล่าสุดที่ใช้คิดอัตราเคส/ชม.
+THROUGHPUT_MIN_SPAN_MINUTES = 10  # ช่วงเวลาขั้นต่ำที่ใช้หาร (เคสที่บันทึกพร้อมกันได้เวลาเดียวกัน)
+SOURCE_WORKERS = 4  # thread ที่ใช้ ingest/enrich หลายห้องพร้อมกัน
+SCHEDULE_CACHE_MAX = 32  # จำนวน (ไฟล์, sheet) ที่ enrich แล้วเก็บไว้ต่อ process
+PRIMARY_ROOM_LABEL = "OR-minor"  # ชื่อห้องของไฟล์หลักที่มี sheet เดียว
+EXPORT_CACHE_MAX = 24  # จำนวนไฟล์ export (ต่อ version/วันที่/สถานะ/รูปแบบ) ที่เก็บไว้ต่อ process
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "proc_rules.json")  # ALIASES + pattern (hot-reload)
+
+# คอลัมน์ที่ dashboard ใช้จริง; คอลัมน์อื่น (ชื่อผู้ป่วย/แพทย์ ฯลฯ) ไม่ถูกอ่านเข้ามาเลย
+PROC_COL_CANDIDATES = ["icd9cm_name", "operation", "opname", "procedure", "proc", "หัตถการ", "ผ่าตัด"]
+TIME_COL_CANDIDATES = ["estmtime", "reqtime", "opetime", "time", "เวลา", "เวลาผ่า", "เวลาเริ่ม"]
+DATE_COL_CANDIDATES = ["estmdate", "opedate"]
+NOTE_COL_CANDIDATES = ["procnote"]
+SCHEDULE_COLUMNS = {
+    c.lower() for c in PROC_COL_CANDIDATES + TIME_COL_CANDIDATES + DATE_COL_CANDIDATES + NOTE_COL_CANDIDATES
+}
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+DB_WRITE_RETRIES = 3  # ลองเปิด write transaction ใหม่กี่ครั้งเมื่อรอ lock เกิน busy_timeout
+DB_LOCK_WAIT_MS = 5  # รอ write lock นานกว่านี้นับเป็นหนึ่งครั้งที่ต้องรอ (lock contention)
+DB_POOL_SIZE = 8  # connection ว่างที่เก็บไว้ใช้ซ้ำทั้ง process (ที่ยืมพร้อมกันเกินนี้ปิดเมื่อคืน)
+
+def _is_lock_error(e: sqlite3.OperationalError) -> bool:
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+class Database:
+    """pool ของ connection (WAL mode) ที่ใช้ร่วมกันทั้ง process แทนการ connect/close ทุกครั้ง
+
+    ยืมทีละครั้งผ่าน connection() / transaction() ไม่ผูกกับ thread: Streamlit รันแต่ละ rerun และ fragment
+    บน thread ใหม่ connection ต่อ thread จึงถูกสร้างใหม่ (พร้อม PRAGMA) ทุกครั้งที่ผู้ใช้กด
+    """
+
+    def __init__(self, path: str, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle: list[sqlite3.Connection] = []
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._lock_stats = {
+            "transactions": 0, "waits": 0, "wait_seconds": 0.0, "retries": 0, "failures": 0, "connections": 0,
+        }
+
+    def _count(self, name: str, seconds: float = 0.0):
+        with self._stats_lock:
+            self._lock_stats[name] += 1
+            if seconds:
+                self._lock_stats["wait_seconds"] += seconds
+
+    def lock_stats(self) -> dict:
+        """จำนวน write transaction / ครั้งที่ต้องรอ write lock / ลองใหม่ / ล้มเหลวเพราะ lock
+        และจำนวน connection ที่เปิดใหม่ (connections) ตั้งแต่เปิด process"""
+        with self._stats_lock:
+            return dict(self._lock_stats)
+
+    def _connect(self) -> sqlite3.Connection:
+        # check_same_thread=False: connection ย้าย thread ได้ แต่ใช้ได้ทีละ thread เพราะยืมจาก pool
+        # cached_statements: sqlite3 เก็บ prepared statement ของ SQL ที่ใช้ซ้ำไว้ต่อ connection
+        conn = sqlite3.connect(self.path, timeout=30, cached_statements=256, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        self._count("connections")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """ยืม connection จาก pool ตลอด block (สำหรับอ่าน) แล้วคืนเข้า pool"""
+        with self._pool_lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._pool_lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def fetchone(self, sql: str, params: tuple = ()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: tuple = ()) -> list:
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """write transaction: จอง write lock ตั้งแต่ BEGIN IMMEDIATE, commit เมื่อจบ block / rollback ถ้ามี exception
+
+        รอ lock เกิน busy_timeout แล้วลองใหม่อีก DB_WRITE_RETRIES ครั้ง การรอ/ลองใหม่นับไว้ใน lock_stats()
+        """
+        with self.connection() as conn:
+            t0 = time.perf_counter()
+            for attempt in range(DB_WRITE_RETRIES + 1):
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if not _is_lock_error(e):
+                        raise
+                    if attempt == DB_WRITE_RETRIES:
+                        self._count("failures")
+                        raise
+                    self._count("retries")
+            waited = time.perf_counter() - t0
+            self._count("transactions")
+            if waited * 1e3 >= DB_LOCK_WAIT_MS:
+                self._count("waits", waited)
+                get_timings().record("db.lock_wait", waited)
+            with conn:
+                yield conn
+
+def init_db(db: Database):
+    with db.transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS completed_cases (
+                upload_date TEXT,
+                file_name TEXT,
+                case_index INTEGER,
+                completed_at TEXT,
+                PRIMARY KEY (upload_date, file_name, case_index)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS proc_classification_cache (
+                proc_text TEXT PRIMARY KEY,
+                rules_version TEXT,
+                norm TEXT,
+                category TEXT,
+                last_used REAL
+            )
+        ''')
+        # สถานะเสร็จแล้วต่อเคส key ด้วย hash ของเนื้อหาเคส (ไม่ใช่เลขแถว) ย้ายไฟล์/แก้ไฟล์แล้วยังตามเคสเดิมได้
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS case_completions (
+                case_key INTEGER PRIMARY KEY,
+                op_date TEXT,
+                completed_at TEXT
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_case_completions_op_date ON case_completions (op_date)")
+        # คลังตารางผ่าตัดย้อนหลัง (แบ่งตามวันที่ผ่าตัด/ห้อง) + rollup shift x category ต่อวัน เขียนตอน ingest
+        create_archive_tables(conn)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archived_files (
+                content_hash TEXT NOT NULL,
+                rules_version TEXT NOT NULL,
+                file_name TEXT,
+                archived_at TEXT,
+                cases INTEGER,
+                PRIMARY KEY (content_hash, rules_version)
+            )
+        ''')
+        # change feed: version เพิ่มทุกครั้งที่สถานะเสร็จแล้วเปลี่ยน (ให้ fragment poll ได้ถูกๆ)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS change_feed (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute("INSERT OR IGNORE INTO change_feed (name, version) VALUES ('completed_cases', 0)")
+        for table in ("completed_cases", "case_completions"):
+            for op in ("INSERT", "DELETE"):
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_feed
+                    AFTER {op} ON {table}
+                    BEGIN
+                        UPDATE change_feed SET version = version + 1 WHERE name = 'completed_cases';
+                    END
+                ''')
+
+def create_archive_tables(conn: sqlite3.Connection):
+    """คลังแบ่งตามวันที่ + ห้อง (room = '' คือไฟล์หลักแบบ sheet เดียว) อัปโหลดห้องหนึ่งไม่ทับข้อมูลอีกห้อง
+
+    คลังรุ่นแรกไม่มีคอลัมน์ room ใน primary key -> สร้างตารางใหม่แล้วย้ายข้อมูลเดิมเป็น room ''
+    """
+    legacy = []
+    for table in ("schedule_archive", "daily_rollups"):
+        cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if cols and "room" not in cols:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_v1")
+            legacy.append((table, ", ".join(cols)))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_archive (
+            op_date TEXT NOT NULL,
+            room TEXT NOT NULL DEFAULT '',
+            case_key INTEGER NOT NULL,
+            proc_text TEXT,
+            category TEXT,
+            shift TEXT,
+            mins INTEGER,
+            content_hash TEXT,
+            PRIMARY KEY (op_date, room, case_key)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            op_date TEXT NOT NULL,
+            room TEXT NOT NULL DEFAULT '',
+            shift TEXT NOT NULL,
+            category TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (op_date, room, shift, category)
+        )
+    ''')
+    for table, cols in legacy:
+        conn.execute(f"INSERT OR REPLACE INTO {table} ({cols}) SELECT {cols} FROM {table}_v1")
+        conn.execute(f"DROP TABLE {table}_v1")
+
+@process_cache()
+def get_db() -> Database:
+    # สร้าง schema ครั้งเดียวต่อ process
+    db = Database(DB_PATH)
+    init_db(db)
+    return db
+
+SQL_SELECT_LEGACY_COMPLETED = "SELECT case_index, completed_at FROM completed_cases WHERE upload_date=? AND file_name=?"
+SQL_DELETE_LEGACY_COMPLETED = "DELETE FROM completed_cases WHERE upload_date=? AND file_name=?"
+SQL_SELECT_COMPLETIONS = "SELECT case_key, completed_at FROM case_completions WHERE op_date=?"
+SQL_INSERT_COMPLETION = """
+    INSERT OR IGNORE INTO case_completions
+    (case_key, op_date, completed_at)
+    VALUES (?, ?, ?)
+"""
+SQL_DELETE_COMPLETION = "DELETE FROM case_completions WHERE case_key=?"
+SQL_COMPLETION_TOKEN = "SELECT version FROM change_feed WHERE name='completed_cases'"
+
+@timed("db.load_completions")
+def load_completions(op_dates) -> list[tuple[int, str]]:
+    """(case_key, completed_at) ของทุกเคสในวันที่ที่ระบุ (ใช้ index op_date)"""
+    rows = []
+    with get_db().connection() as conn:
+        for op_date in op_dates:
+            rows.extend(conn.execute(SQL_SELECT_COMPLETIONS, (op_date,)).fetchall())
+    return rows
+
+@timed("db.mark_completed")
+def mark_completed_many(case_keys, op_dates):
+    now = datetime.now().isoformat()
+    rows = [(int(k), str(d), now) for k, d in zip(case_keys, op_dates)]
+    if not rows:
+        return
+    with get_db().transaction() as conn:
+        conn.executemany(SQL_INSERT_COMPLETION, rows)
+
+def mark_completed(case_key: int, op_date: str):
+    mark_completed_many([case_key], [op_date])
+
+@timed("db.unmark_completed")
+def unmark_completed_many(case_keys):
+    rows = [(int(k),) for k in case_keys]
+    if not rows:
+        return
+    with get_db().transaction() as conn:
+        conn.executemany(SQL_DELETE_COMPLETION, rows)
+
+def reset_completed_cases(case_keys):
+    unmark_completed_many(case_keys)
+
+def migrate_legacy_completions(upload_date: str, file_name: str, case_keys: np.ndarray, op_dates: np.ndarray):
+    """ย้ายสถานะแบบเดิม (upload_date, file_name, case_index) มาเป็น case_key ของไฟล์ปัจจุบัน"""
+    legacy = get_db().fetchall(SQL_SELECT_LEGACY_COMPLETED, (upload_date, file_name))
+    if not legacy:
+        return
+    rows = [(int(case_keys[i]), str(op_dates[i]), ts) for i, ts in legacy if 0 <= i < len(case_keys)]
+    with get_db().transaction() as conn:
+        conn.executemany(SQL_INSERT_COMPLETION, rows)
+        conn.execute(SQL_DELETE_LEGACY_COMPLETED, (upload_date, file_name))
+
+@timed("db.completion_token")
+def completion_token() -> int:
+    row = get_db().fetchone(SQL_COMPLETION_TOKEN)
+    return row[0] if row else 0
+
+class CompletionState:
+    """สถานะเสร็จแล้วของไฟล์หนึ่ง ใช้ร่วมกันทุก session ใน process (bitmap ตามลำดับแถวของ frame)
+
+    โหลดจาก DB ใหม่เฉพาะเมื่อ change token เปลี่ยน แล้ว map case_key -> ตำแหน่งแถวด้วย index
+    สลับทั้งชุดทีเดียว session ที่อ่าน mask อยู่จึงเห็นข้อมูลชุดเดียวกันเสมอ
+    """
+
+    def __init__(self, case_keys: np.ndarray, op_dates: np.ndarray):
+        self.n_cases = len(case_keys)
+        self.key_index = pd.Index(case_keys)
+        self.op_dates = sorted(set(op_dates.tolist()))
+        self.token: int | None = None
+        self.indices: frozenset[int] = frozenset()
+        self.mask = np.zeros(self.n_cases, dtype=bool)
+        self.completed_at = np.full(self.n_cases, np.datetime64("NaT"), dtype="datetime64[s]")
+        self.times_sorted = np.array([], dtype="datetime64[s]")
+        self._lock = threading.Lock()
+
+    def sync(self) -> "CompletionState":
+        token = completion_token()
+        if token != self.token:
+            with self._lock:
+                if token != self.token:
+                    rows = load_completions(self.op_dates)
+                    pos = self.key_index.get_indexer(np.array([r[0] for r in rows], dtype=np.int64))
+                    found = pos >= 0
+                    idx = pos[found]
+                    mask = np.zeros(self.n_cases, dtype=bool)
+                    mask[idx] = True
+                    completed_at = np.full(self.n_cases, np.datetime64("NaT"), dtype="datetime64[s]")
+                    completed_at[idx] = np.array([r[1] for r in rows], dtype="datetime64[s]")[found]
+                    times_sorted = np.sort(completed_at[mask])
+                    for arr in (mask, completed_at, times_sorted):
+                        arr.flags.writeable = False
+                    self.indices, self.mask, self.completed_at, self.times_sorted, self.token = (
+                        frozenset(idx.tolist()), mask, completed_at, times_sorted, token
+                    )
+        return self
+
+    def snapshot(self) -> tuple[int | None, np.ndarray, np.ndarray]:
+        """(token, mask, completed_at) ชุดเดียวกัน (ไม่ปนกับ sync ที่เกิดพร้อมกัน)"""
+        with self._lock:
+            return self.token, self.mask, self.completed_at
+
+    def throughput_per_hour(self, now: datetime, window_minutes: int = THROUGHPUT_WINDOW_MINUTES) -> float | None:
+        """อัตราเคส/ชม. จากเคสที่เสร็จในช่วง window ล่าสุด (ถ้าน้อยกว่า 2 เคสใช้ตั้งแต่เคสแรกที่เสร็จ)
+
+        หารด้วยเวลาตั้งแต่เคสแรกในช่วงนั้น (ไม่เกิน window) ช่วงแรกของวันจึงไม่ถูกหารด้วย window เต็ม
+        เคสที่บันทึกพร้อมกันหลายเคสได้เวลาเดียวกัน จึงหารด้วยอย่างน้อย THROUGHPUT_MIN_SPAN_MINUTES
+        """
+        times = self.times_sorted
+        if len(times) == 0:
+            return None
+        now64 = np.datetime64(now.replace(microsecond=0), "s")
+        start = now64 - np.timedelta64(window_minutes, "m")
+        first = int(np.searchsorted(times, start, side="left"))
+        if len(times) - first < 2:
+            first = 0
+        span_m = max((now64 - times[first]) / np.timedelta64(1, "m"), THROUGHPUT_MIN_SPAN_MINUTES)
+        return (len(times) - first) / (span_m / 60)
+
+def legacy_case_order(df_raw: pd.DataFrame) -> np.ndarray:
+    """ตำแหน่งแถวของ df_raw เรียงตามเลขเคสแบบเดิม (case_index)
+
+    หน้าเดิมเรียงด้วย sort_values ตาม estmtime แบบ default (quicksort ไม่ stable) ต้องเรียงแบบเดียวกันทุกอย่าง
+    รวมถึง dtype (ไม่มีค่าว่างได้ int64) ไม่อย่างนั้นเคสที่เวลาซ้ำกันได้ลำดับต่างไป
+    """
+    if "estmtime" not in df_raw.columns:
+        return np.arange(len(df_raw))
+    est = minutes_from_series(df_raw["estmtime"]).reset_index(drop=True)
+    if not est.isna().any():
+        est = est.astype(np.int64)
+    return pd.DataFrame({"__est_sort__": est}).sort_values("__est_sort__", na_position="last").index.to_numpy()
+
+@process_cache(max_entries=8)
+def ensure_legacy_migrated(source: "ScheduleSource", upload_date: str, file_name: str, _df_work: pd.DataFrame) -> bool:
+    """ย้ายสถานะแบบเดิมครั้งเดียวต่อ version ของไฟล์หลัก (_df_work = frame ที่ enrich แล้วของ source นี้เท่านั้น)
+
+    case_index แบบเดิม -> แถวของไฟล์ดิบ (legacy_case_order) -> แถวของ _df_work (enrich_schedule เรียง estmtime แบบ stable)
+    """
+    df_raw = load_schedule(source.path, source.content_hash, source.sheet)[0].rename(columns=lambda c: str(c).strip())
+    raw_rows = np.arange(len(df_raw))
+    if "estmtime" in df_raw.columns:
+        raw_rows = np.argsort(minutes_from_series(df_raw["estmtime"]).to_numpy(dtype=float), kind="stable")
+    case_keys = np.empty(len(df_raw), dtype=np.int64)
+    op_dates = np.empty(len(df_raw), dtype=object)
+    case_keys[raw_rows] = _df_work["__case_key__"].to_numpy()
+    op_dates[raw_rows] = _df_work["__op_date__"].astype(str).to_numpy()
+    legacy = legacy_case_order(df_raw)
+    migrate_legacy_completions(upload_date, file_name, case_keys[legacy], op_dates[legacy])
+    return True
+
+@process_cache(max_entries=32)
+def get_completion_state(content_hash: str, op_date: str | None, _df_work: pd.DataFrame) -> CompletionState:
+    return CompletionState(_df_work["__case_key__"].to_numpy(), _df_work["__op_date__"].astype(str).to_numpy())
+
+def sync_completed_cases(content_hash: str, op_date: str | None, df_work: pd.DataFrame) -> CompletionState:
+    """สถานะเสร็จแล้วล่าสุดของวันหนึ่ง (op_date=None คือทั้ง frame) โหลดจาก DB ใหม่เฉพาะเมื่อ change token เปลี่ยน"""
+    return get_completion_state(content_hash, op_date, df_work).sync()
+
+# ===============================
+# COLUMNAR SIDECAR CACHE
+# ===============================
+def content_hash_bytes(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+@process_cache(max_entries=16)
+def _file_content_hash(path: str, mtime_ns: int, size: int) -> str:
+    # mtime/size เป็นส่วนหนึ่งของ cache key -> hash ใหม่เฉพาะเมื่อไฟล์เปลี่ยน
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_content_hash(path: str) -> str:
+    stat = os.stat(path)
+    return _file_content_hash(path, stat.st_mtime_ns, stat.st_size)
+
+def file_date(path: str) -> str | None:
+    """วันที่แก้ไขไฟล์ (YYYY-MM-DD) ใช้เป็นวันผ่าตัดของไฟล์ที่ไม่มีคอลัมน์วันที่"""
+    if not os.path.exists(path):
+        return None
+    return dt.date.fromtimestamp(os.stat(path).st_mtime).isoformat()
+
+def source_version(content_hash: str, sheet: str | None = None) -> str:
+    """version ของข้อมูลหนึ่ง sheet: hash ของไฟล์ (+ hash ชื่อ sheet ถ้าไม่ใช่ sheet แรกแบบไฟล์ sheet เดียว)"""
+    if sheet is None:
+        return content_hash
+    return f"{content_hash}_{hashlib.sha1(sheet.encode('utf-8')).hexdigest()[:8]}"
+
+def _sidecar_base(content_hash: str) -> str:
+    return os.path.join(SIDECAR_DIR, f"schedule_{content_hash}_{SIDECAR_FORMAT}")
+
+@timed("file.write_sidecar")
+def write_sidecar(df: pd.DataFrame, content_hash: str) -> str:
+    os.makedirs(SIDECAR_DIR, exist_ok=True)
+    base = _sidecar_base(content_hash)
+    try:
+        tmp = base + ".parquet.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, base + ".parquet")
+        path = base + ".parquet"
+    except Exception:
+        # ไม่มี pyarrow หรือคอลัมน์มีชนิดข้อมูลปนกัน (เช่นเวลาเป็นทั้งตัวเลขและข้อความ) -> ใช้ pickle แทน
+        tmp = base + ".pkl.tmp"
+        df.to_pickle(tmp)
+        os.replace(tmp, base + ".pkl")
+        path = base + ".pkl"
+    prune_sidecars(keep=SIDECAR_KEEP)
+    return path
+
+def read_sidecar(content_hash: str) -> pd.DataFrame | None:
+    base = _sidecar_base(content_hash)
+    if os.path.exists(base + ".parquet"):
+        try:
+            return pd.read_parquet(base + ".parquet", memory_map=True)
+        except Exception:
+            pass
+    if os.path.exists(base + ".pkl"):
+        try:
+            return pd.read_pickle(base + ".pkl")
+        except Exception:
+            pass
+    return None
+
+def prune_sidecars(keep: int = SIDECAR_KEEP):
+    if not os.path.isdir(SIDECAR_DIR):
+        return
+    paths = [os.path.join(SIDECAR_DIR, f) for f in os.listdir(SIDECAR_DIR) if f.startswith("schedule_")]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for old in paths[keep:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+def _is_schedule_column(name) -> bool:
+    return str(name).strip().lower() in SCHEDULE_COLUMNS
+
+@timed("file.read_excel")
+def read_schedule_excel(path: str, sheet: str | None = None) -> pd.DataFrame:
+    """parse Excel เฉพาะคอลัมน์ใน SCHEDULE_COLUMNS (sheet=None คือ sheet แรก)"""
+    return pd.read_excel(path, sheet_name=0 if sheet is None else sheet, usecols=_is_schedule_column)
+
+@timed("file.read_excel")
+def read_schedule_workbook(path: str) -> dict[str | None, pd.DataFrame]:
+    """parse ทุก sheet ที่มีคอลัมน์ตารางผ่าตัดในรอบเดียว key ตาม workbook_sheets (None = ไฟล์ sheet เดียว)"""
+    frames = pd.read_excel(path, sheet_name=None, usecols=_is_schedule_column)
+    sheets = _schedule_sheet_names(list(frames), [len(df.columns) > 0 for df in frames.values()])
+    names = list(frames)
+    return {sheet: frames[names[0] if sheet is None else sheet] for sheet in sheets}
+
+def _schedule_sheet_names(names: list[str], has_columns: list[bool]) -> list[str | None]:
+    schedule = [n for n, ok in zip(names, has_columns) if ok]
+    # ไฟล์ที่มีตารางผ่าตัดแค่ sheet แรก ใช้ key/version แบบไฟล์ sheet เดียว (ข้อมูลเดิมใช้ต่อได้)
+    if not schedule or schedule == names[:1]:
+        return [None]
+    return schedule
+
+def _sheets_sidecar(content_hash: str) -> str:
+    return os.path.join(SIDECAR_DIR, f"schedule_{content_hash}_sheets.json")
+
+def write_sheet_list(content_hash: str, sheets: list[str | None]):
+    os.makedirs(SIDECAR_DIR, exist_ok=True)
+    tmp = _sheets_sidecar(content_hash) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(sheets, f, ensure_ascii=False)
+    os.replace(tmp, _sheets_sidecar(content_hash))
+
+def workbook_sheets(path: str, content_hash: str) -> list[str | None]:
+    """รายชื่อ sheet ที่เป็นตารางผ่าตัด (จำไว้ใน sidecar ต่อ hash ไม่ต้องเปิดไฟล์ Excel ซ้ำ)"""
+    try:
+        with open(_sheets_sidecar(content_hash), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    with pd.ExcelFile(path) as xl:
+        names = list(xl.sheet_names)
+        has_columns = [len(pd.read_excel(xl, sheet_name=n, nrows=0, usecols=_is_schedule_column).columns) > 0
+                       for n in names]
+    sheets = _schedule_sheet_names(names, has_columns)
+    write_sheet_list(content_hash, sheets)
+    return sheets
+
+@timed("file.load_schedule")
+def load_schedule(path: str, content_hash: str | None = None, sheet: str | None = None) -> tuple[pd.DataFrame, str]:
+    """อ่านตารางผ่าตัดจาก sidecar ถ้ามี; parse Excel เฉพาะเมื่อ hash ของไฟล์เปลี่ยน"""
+    content_hash = content_hash or file_content_hash(path)
+    version = source_version(content_hash, sheet)
+    df = read_sidecar(version)
+    if df is None:
+        df = read_schedule_excel(path, sheet)
+        write_sidecar(df, version)
+    return df, content_hash
+
+def frame_memory_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(index=True, deep=True).sum() / 1e6
+
+def memory_report(path: str, df_compact: pd.DataFrame) -> pd.DataFrame:
+    """เปรียบเทียบหน่วยความจำ: อ่านทุกคอลัมน์ + คอลัมน์ enrich แบบ object (แบบเดิม) กับ frame ที่ใช้อยู่"""
+    full = pd.read_excel(path)
+    legacy = full.assign(
+        __norm__=df_compact["__norm__"].astype(object).to_numpy(),
+        __proc_category__=df_compact["__proc_category__"].astype(object).to_numpy(),
+        __mins__=df_compact["__mins__"].astype(float).to_numpy(),
+        __shift__=df_compact["__shift__"].astype(object).to_numpy(),
+    ) if len(full) == len(df_compact) else full
+    rows = [
+        ("เต็ม (ทุกคอลัมน์, object dtype)", legacy.shape[1], frame_memory_mb(legacy)),
+        ("ตัดคอลัมน์ + categorical/Int16", df_compact.shape[1], frame_memory_mb(df_compact)),
+    ]
+    report = pd.DataFrame(rows, columns=["frame", "columns", "MB"])
+    report["MB"] = report["MB"].round(3)
+    return report
+
+# ===============================
+# Shift labels
+# ===============================
+SHIFT_ORDER = ["AM", "PM", "Unknown"]
+SHIFT_LABEL_MAP = {"AM": "เช้า", "PM": "บ่าย", "Unknown": "TF"}
+
+# ===============================
+# COLUMN PICKER
+# ===============================
+def pick_text_col(df: pd.DataFrame, candidates: list[str]) -> str | None:
+    cols = {str(c).strip().lower(): str(c).strip() for c in df.columns}
+    for c in candidates:
+        if c.lower() in cols:
+            return cols[c.lower()]
+    return None
+
+# ===============================
+# PROCEDURE CATEGORIES & ALIASES (โหลดจาก proc_rules.json)
+# ===============================
+_RE_WS = re.compile(r"\s+")
+_RE_EC = re.compile(r"\be\s*[\.\-\s]\s*c\b")
+_RE_ID = re.compile(r"\bi\s*(?:\+|&|\band\b)\s*d\b")
+_RE_INCISION_DRAINAGE = re.compile(r"\bincision\s*(?:&|\band\b)?\s*drainage\b")
+_RE_PUNCT = re.compile(r"[,\.;:\(\)\[\]\{\}]")
+
+class RuleSet:
+    """ALIASES + category patterns ที่ compile แล้ว (rewrite alias ในรอบเดียว, longest match ก่อน)"""
+
+    def __init__(self, spec: dict, version: str):
+        self.version = version
+        self.aliases: dict[str, str] = {str(k).lower(): str(v) for k, v in spec["aliases"].items()}
+        keys = sorted(self.aliases, key=len, reverse=True)
+        self._alias_re = re.compile("|".join(re.escape(k) for k in keys)) if keys else None
+        self.rules: list[tuple[str, re.Pattern]] = [
+            (r["category"], re.compile(r["pattern"])) for r in spec["rules"]
+        ]
+        # choices ของ fuzzy matching สร้างครั้งเดียวต่อชุด rules
+        pairs = [(cat, term) for cat, terms in spec.get("fuzzy_terms", {}).items() for term in terms]
+        self.fuzzy_choices: list[str] = [term for _, term in pairs]
+        self.fuzzy_choice_categories = np.array([cat for cat, _ in pairs] + ["Other"], dtype=object)
+        # ลำดับ category ที่ใช้เป็น categorical dtype (รวม category ที่มีใน rules/fuzzy แต่ลืมใส่ใน list)
+        self.categories: list[str] = list(dict.fromkeys(
+            [c for c in spec["categories"] if c != "Other"]
+            + [cat for cat, _ in self.rules]
+            + [cat for cat, _ in pairs]
+            + ["Other"]
+        ))
+
+    @classmethod
+    def from_file(cls, path: str) -> "RuleSet":
+        with open(path, "rb") as f:
+            data = f.read()
+        return cls(json.loads(data.decode("utf-8")), version=hashlib.sha1(data).hexdigest()[:12])
+
+    def normalize(self, x) -> str:
+        if pd.isna(x):
+            return ""
+        s = str(x).lower().strip()
+        s = s.replace("\u00a0", " ")
+        s = _RE_WS.sub(" ", s)
+        s = _RE_EC.sub("ec", s)
+        if self._alias_re is not None:
+            s = self._alias_re.sub(lambda m: self.aliases[m.group(0)], s)
+        s = _RE_ID.sub("i+d", s)
+        s = _RE_INCISION_DRAINAGE.sub("incision drainage", s)
+        s = _RE_PUNCT.sub(" ", s)
+        s = _RE_WS.sub(" ", s).strip()
+        return s
+
+    def classify_normalized(self, s: str) -> str:
+        for cat, pattern in self.rules:
+            if pattern.search(s):
+                return cat
+        return "Other"
+
+class RulesHolder:
+    """เก็บ RuleSet ปัจจุบัน และโหลดใหม่เมื่อ mtime ของไฟล์ rules เปลี่ยน"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.error: str | None = None
+        self._lock = threading.Lock()
+        self._mtime_ns = os.stat(path).st_mtime_ns
+        self._rules = RuleSet.from_file(path)
+
+    def get(self) -> RuleSet:
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self._rules
+        if mtime_ns != self._mtime_ns:
+            with self._lock:
+                if mtime_ns != self._mtime_ns:
+                    try:
+                        self._rules = RuleSet.from_file(self.path)
+                        self.error = None
+                    except Exception as e:
+                        # ไฟล์ rules เสีย -> ใช้ชุดเดิมต่อ
+                        self.error = f"{type(e).__name__}: {e}"
+                    self._mtime_ns = mtime_ns
+        return self._rules
+
+@process_cache()
+def get_rules_holder() -> RulesHolder:
+    return RulesHolder(RULES_PATH)
+
+def get_rules() -> RuleSet:
+    return get_rules_holder().get()
+
+def normalize_proc_text(x: str, rules: RuleSet | None = None) -> str:
+    return (rules or get_rules()).normalize(x)
+
+def classify_proc_category_rules(proc_text: str, rules: RuleSet | None = None) -> str:
+    rules = rules or get_rules()
+    return rules.classify_normalized(rules.normalize(proc_text))
+
+def classify_proc_category(proc_text: str, use_fuzzy: bool = False, threshold: int = 85) -> str:
+    rules = get_rules()
+    s = rules.normalize(proc_text)
+    base = rules.classify_normalized(s)
+    if (not use_fuzzy) or (base != "Other"):
+        return base
+    scores, cats = get_fuzzy_cache().best_matches([s], rules)
+    return cats[0] if scores[0] >= threshold else "Other"
+
+# ===============================
+# FUZZY MATCHING (batched + cache คะแนนที่ไม่ขึ้นกับ threshold)
+# ===============================
+def _load_rapidfuzz():
+    try:
+        from rapidfuzz import process, fuzz
+    except Exception:
+        return None
+    return process, fuzz
+
+class FuzzyScoreCache:
+    """normalized string -> (best score, category) ต่อ version ของ rules; threshold ใช้แค่ตัดตอนท้าย"""
+
+    def __init__(self):
+        self.version: str | None = None
+        self._scores: dict[str, tuple[float, str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @timed("fuzzy.best_matches")
+    def best_matches(self, norms: list[str], rules: RuleSet) -> tuple[np.ndarray, np.ndarray]:
+        with self._lock:
+            if rules.version != self.version:
+                self.version = rules.version
+                self._scores = {}
+            unique = [s for s in dict.fromkeys(norms) if s]
+            missing = [s for s in unique if s not in self._scores]
+            self.misses += len(missing)
+            self.hits += len(unique) - len(missing)
+        rf = _load_rapidfuzz()
+        if missing and rf is not None and rules.fuzzy_choices:
+            process, fuzz = rf
+            matrix = process.cdist(
+                missing, rules.fuzzy_choices, scorer=fuzz.token_set_ratio, dtype=np.float64, workers=-1
+            )
+            best = matrix.argmax(axis=1)
+            best_scores = matrix[np.arange(len(missing)), best]
+            with self._lock:
+                for s, idx, score in zip(missing, best, best_scores):
+                    self._scores[s] = (float(score), rules.fuzzy_choice_categories[idx])
+        with self._lock:
+            hits = [self._scores.get(s, (0.0, "Other")) for s in norms]
+        scores = np.array([h[0] for h in hits], dtype=float)
+        cats = np.array([h[1] for h in hits], dtype=object)
+        return scores, cats
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "entries": len(self._scores),
+        }
+
+@process_cache()
+def get_fuzzy_cache() -> FuzzyScoreCache:
+    return FuzzyScoreCache()
+
+# ===============================
+# CLASSIFICATION CACHE (unique values + LRU ที่เก็บใน SQLite)
+# ===============================
+class ClassificationCache:
+    """LRU ของ procedure string -> (normalized, category) ที่ persist ลง or_dashboard.db
+
+    แต่ละ entry ผูกกับ version ของ proc_rules.json เมื่อ rules เปลี่ยนจะโหลดชุดของ version ใหม่แทน
+    entry เก่าใน DB ไม่ถูกลบทิ้ง แค่ค่อยๆ ถูก classify ใหม่เมื่อเจอ string นั้นอีก
+    """
+
+    def __init__(self, db: Database, max_entries: int = CLASSIFICATION_CACHE_MAX):
+        self.db = db
+        self.max_entries = max_entries
+        self.version = get_rules().version
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[str, str]] = OrderedDict()
+        self._touched: set[str] = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        self._data.clear()
+        self._touched.clear()
+        rows = self.db.fetchall(
+            "SELECT proc_text, norm, category FROM proc_classification_cache "
+            "WHERE rules_version=? ORDER BY last_used ASC LIMIT ?",
+            (self.version, self.max_entries),
+        )
+        for text, norm, cat in rows:
+            self._data[text] = (norm, cat)
+
+    def classify_many(self, texts: list[str], rules: RuleSet | None = None) -> list[tuple[str, str]]:
+        rules = rules or get_rules()
+        if rules.version != self.version:
+            self.flush()
+            with self._lock:
+                self.version = rules.version
+                self._load()
+        out = []
+        with self._lock:
+            for text in texts:
+                hit = self._data.get(text)
+                if hit is None:
+                    self.misses += 1
+                    norm = rules.normalize(text)
+                    hit = (norm, rules.classify_normalized(norm))
+                    self._data[text] = hit
+                else:
+                    self.hits += 1
+                    self._data.move_to_end(text)
+                self._touched.add(text)
+                out.append(hit)
+            while len(self._data) > self.max_entries:
+                evicted, _ = self._data.popitem(last=False)
+                self._touched.discard(evicted)
+        return out
+
+    def flush(self):
+        with self._lock:
+            if not self._touched:
+                return
+            now = time.time()
+            rows = [(t, self.version, *self._data[t], now) for t in self._touched]
+            self._touched = set()
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO proc_classification_cache "
+                "(proc_text, rules_version, norm, category, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute(
+                "DELETE FROM proc_classification_cache WHERE proc_text NOT IN ("
+                "SELECT proc_text FROM proc_classification_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "entries": len(self._data),
+        }
+
+@process_cache()
+def get_classification_cache() -> ClassificationCache:
+    return ClassificationCache(get_db())
+
+@timed("classify.series")
+def classify_series(values: pd.Series, rules: RuleSet | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """classify เฉพาะค่าที่ไม่ซ้ำ แล้ว map กลับเป็น (normalized, category) ของทุกแถว"""
+    codes, uniques = pd.factorize(values)
+    cache = get_classification_cache()
+    results = cache.classify_many([str(u) for u in uniques], rules=rules)
+    cache.flush()
+    # code -1 (ค่าว่าง/NaN) ชี้ไปที่ช่องสุดท้าย
+    norms = np.array([r[0] for r in results] + [""], dtype=object)
+    cats = np.array([r[1] for r in results] + ["Other"], dtype=object)
+    return norms[codes], cats[codes]
+
+# ===============================
+# TIME PARSING (vectorized)
+# ===============================
+def minutes_from_series(values: pd.Series) -> pd.Series:
+    """เวลาแบบ HHMM (ตัวเลข) หรือ "HH:MM" -> นาทีนับจากเที่ยงคืน (NaN ถ้าแปลงไม่ได้)"""
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        num = values.astype(float)
+        text = None
+    else:
+        text = values.astype("string").str.strip()
+        num = pd.to_numeric(text, errors="coerce").astype(float)
+    xi = np.trunc(num.to_numpy())
+    with np.errstate(invalid="ignore"):
+        hh, mm = xi // 100, xi % 100
+    valid = (hh >= 0) & (hh <= 23) & (mm >= 0) & (mm <= 59)
+    mins = np.where(valid, hh * 60 + mm, np.nan)
+    if text is not None:
+        hhmm = text.str.extract(r"^(\d{1,2}):(\d{2})$").astype(float).to_numpy()
+        sh, sm = hhmm[:, 0], hhmm[:, 1]
+        valid_str = (sh <= 23) & (sm <= 59)
+        mins = np.where(~valid & valid_str, sh * 60 + sm, mins)
+    return pd.Series(mins, index=values.index)
+
+def shift_from_minutes(mins: pd.Series) -> np.ndarray:
+    m = mins.to_numpy(dtype=float)
+    return np.where(np.isnan(m), "Unknown", np.where(m < 12 * 60, "AM", "PM")).astype(object)
+
+# ===============================
+# ENRICHMENT (คำนวณครั้งเดียวต่อเวอร์ชันไฟล์)
+# ===============================
+def op_dates_from_series(values: pd.Series | None, n: int, fallback_date: str | None = None) -> np.ndarray:
+    """วันที่ผ่าตัดของแต่ละแถวเป็น "YYYY-MM-DD" (แถวที่แปลงไม่ได้ใช้ fallback_date)"""
+    fallback = fallback_date or dt.date.today().isoformat()
+    if values is None:
+        return np.full(n, fallback, dtype=object)
+    # วันที่ซ้ำกันเกือบทั้งคอลัมน์: parse ครั้งเดียวต่อค่าที่ไม่ซ้ำ แล้วกระจายกลับด้วย codes
+    codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(pd.Series(uniques), errors="coerce", format="mixed")
+    days = parsed.dt.strftime("%Y-%m-%d").fillna(fallback).to_numpy(dtype=object)
+    out = np.full(n, fallback, dtype=object)
+    valid = codes >= 0
+    out[valid] = days[codes[valid]]
+    return out
+
+def case_keys_from_columns(
+    op_dates: np.ndarray, proc: pd.Series | None, note: pd.Series | None, scope: str | None = None
+) -> np.ndarray:
+    """key ของเคส (int64) จาก hash ของวันที่ผ่าตัด + หัตถการ + proc note (ไม่ใช้ข้อมูลผู้ป่วย)
+
+    แถวที่เนื้อหาซ้ำกันแยกด้วยลำดับที่พบในไฟล์ เคสเดิมจึงได้ key เดิมแม้แถวย้ายที่หรือเวลาเปลี่ยน
+    scope (ชื่อห้อง) แยก key ของเคสที่เหมือนกันในคนละห้อง
+    """
+    def text(col: pd.Series | None) -> pd.Series:
+        if col is None:
+            return pd.Series("", index=range(len(op_dates)))
+        return col.astype("string").str.strip().fillna("").reset_index(drop=True)
+
+    ident = pd.DataFrame({"op_date": op_dates, "proc": text(proc), "note": text(note)})
+    if scope is not None:
+        ident["scope"] = scope
+    row_hash = pd.util.hash_pandas_object(ident, index=False)
+    occurrence = row_hash.groupby(row_hash).cumcount()
+    keyed = pd.DataFrame({"row": row_hash.to_numpy(), "occurrence": occurrence.to_numpy()})
+    return pd.util.hash_pandas_object(keyed, index=False).to_numpy().view(np.int64)
+
+@timed("enrich_schedule")
+def enrich_schedule(
+    df_raw_in: pd.DataFrame,
+    previous: tuple[pd.DataFrame, dict] | None = None,
+    fallback_date: str | None = None,
+    scope: str | None = None,
+) -> tuple[pd.DataFrame, dict]:
+    """เพิ่มคอลัมน์ category / normalized text / minutes / shift / case key ให้ทุกแถวครั้งเดียว
+
+    category/shift/normalized text เป็น categorical dtype, minutes เป็น Int16
+    ถ้าส่ง previous (ไฟล์เวอร์ชันก่อน) มา แถวที่ case key ตรงกันใช้ผล classify เดิม classify เฉพาะแถวใหม่/ที่แก้
+    """
+    rules = get_rules()
+    # rename ไม่ copy ข้อมูล (copy-on-write) คอลัมน์เดิมใช้ร่วมกับ frame ที่ส่งเข้ามา
+    df = df_raw_in.rename(columns=lambda c: str(c).strip())
+    proc_col = pick_text_col(df, PROC_COL_CANDIDATES)
+    time_col = pick_text_col(df, TIME_COL_CANDIDATES)
+    date_col = pick_text_col(df, DATE_COL_CANDIDATES)
+    note_col = pick_text_col(df, NOTE_COL_CANDIDATES)
+    op_dates = op_dates_from_series(df[date_col] if date_col else None, len(df), fallback_date)
+    case_keys = case_keys_from_columns(
+        op_dates, df[proc_col] if proc_col else None, df[note_col] if note_col else None, scope
+    )
+    rows_reused = 0
+    if proc_col is None:
+        norms = np.full(len(df), "", dtype=object)
+        cats = np.full(len(df), "Other", dtype=object)
+    else:
+        reuse = np.zeros(len(df), dtype=bool)
+        if previous is not None and previous[1].get("rules_version") == rules.version:
+            prev_df = previous[0]
+            pos = pd.Index(prev_df["__case_key__"].to_numpy()).get_indexer(case_keys)
+            reuse = pos >= 0
+        if len(df) and reuse.all():
+            norms = prev_df["__norm__"].to_numpy(dtype=object)[pos]
+            cats = prev_df["__proc_category__"].to_numpy(dtype=object)[pos]
+        elif reuse.any():
+            norms = np.empty(len(df), dtype=object)
+            cats = np.empty(len(df), dtype=object)
+            norms[reuse] = prev_df["__norm__"].to_numpy(dtype=object)[pos[reuse]]
+            cats[reuse] = prev_df["__proc_category__"].to_numpy(dtype=object)[pos[reuse]]
+            norms[~reuse], cats[~reuse] = classify_series(df[proc_col][~reuse], rules=rules)
+        else:
+            norms, cats = classify_series(df[proc_col], rules=rules)
+        rows_reused = int(reuse.sum())
+    if time_col is None:
+        mins = pd.Series(np.nan, index=df.index)
+    else:
+        mins = minutes_from_series(df[time_col])
+    # ข้อความหัตถการ/โน้ตซ้ำกันมาก เก็บเป็น categorical
+    for col in {proc_col, note_col} - {None}:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    df["__norm__"] = pd.Categorical(norms)
+    df["__proc_category__"] = pd.Categorical(cats, categories=rules.categories)
+    df["__mins__"] = mins.astype("Int16")
+    df["__shift__"] = pd.Categorical(shift_from_minutes(mins), categories=SHIFT_ORDER)
+    df["__op_date__"] = pd.Categorical(op_dates)
+    df["__case_key__"] = case_keys
+    # เรียงตาม estmtime ครั้งเดียว: ลำดับแถวของ frame นี้คือเลขเคสในรายการผ่าตัดวันนี้
+    if "estmtime" in df.columns:
+        est = mins if time_col == "estmtime" else minutes_from_series(df["estmtime"])
+        df = df.iloc[np.argsort(est.to_numpy(), kind="stable")].reset_index(drop=True)
+    meta = {
+        "proc_col_used": proc_col,
+        "time_col_used": time_col,
+        "cases_total": len(df),
+        "rules_version": rules.version,
+        "rows_reused": rows_reused,
+        "rows_enriched": len(df) - rows_reused,
+    }
+    return df, meta
+
+@process_cache(max_entries=SCHEDULE_CACHE_MAX)
+def get_schedule(
+    path: str, content_hash: str, rules_version: str, sheet: str | None = None, scope: str | None = None,
+    fallback_date: str | None = None, _previous: tuple[pd.DataFrame, dict] | None = None,
+) -> tuple[pd.DataFrame, dict]:
+    """ตารางที่ enrich แล้วของไฟล์ (sheet) เวอร์ชันหนึ่ง เก็บชุดเดียวต่อ process ทุก session อ้างถึง object เดียวกัน
+
+    ห้ามแก้ frame ที่ได้ไป (อ่านอย่างเดียว) ถ้าต้องการคอลัมน์เพิ่มให้สร้าง Series แยก
+    fallback_date (อยู่ใน cache key) คือวันผ่าตัดของแถวที่ไม่มีวันที่ ผู้เรียกส่งวันที่ของไฟล์ที่จะใช้งานจริงมา
+    _previous (ไม่อยู่ใน cache key) คือเวอร์ชันก่อนหน้า ใช้ diff เพื่อ classify เฉพาะแถวที่เปลี่ยน
+    """
+    df_raw, _ = load_schedule(path, content_hash, sheet)
+    return enrich_schedule(df_raw, previous=_previous, fallback_date=fallback_date, scope=scope)
+
+def fuzzy_categories(df_work: pd.DataFrame, threshold: int) -> pd.Series:
+    """category หลังใช้ fuzzy: match เฉพาะ string ที่เป็น Other; เปลี่ยน threshold ไม่ต้อง match ใหม่"""
+    cats = df_work["__proc_category__"]
+    other = (cats == "Other").to_numpy()
+    if not other.any():
+        return cats
+    codes, uniques = pd.factorize(df_work["__norm__"].to_numpy()[other])
+    scores, best = get_fuzzy_cache().best_matches(list(uniques), get_rules())
+    fuzzy = np.where(scores >= threshold, best, "Other")
+    out = cats.to_numpy(dtype=object, copy=True)
+    out[other] = fuzzy[codes]
+    return pd.Series(pd.Categorical(out, categories=cats.cat.categories), index=cats.index)
+
+# ===============================
+# BUILD SUMMARY
+# ===============================
+@timed("build_daily_summary")
+def build_daily_summary(df_work: pd.DataFrame, meta: dict, categories: pd.Series | None = None):
+    cats = df_work["__proc_category__"] if categories is None else categories
+    category_counts = cats.value_counts()
+    category_counts = category_counts[(category_counts.index != "Other") & (category_counts > 0)]
+    # shift x category นับด้วย bincount บน categorical codes
+    cat_names = list(cats.cat.categories)
+    shift_codes = df_work["__shift__"].cat.codes.to_numpy().astype(np.int64)
+    cat_codes = cats.cat.codes.to_numpy().astype(np.int64)
+    counts = np.bincount(
+        shift_codes * len(cat_names) + cat_codes, minlength=len(SHIFT_ORDER) * len(cat_names)
+    ).reshape(len(SHIFT_ORDER), len(cat_names))
+    pivot = pd.DataFrame(counts, index=pd.Index(SHIFT_ORDER, name="Shift"), columns=cat_names)
+    for col in get_rules().categories:
+        if col not in pivot.columns:
+            pivot[col] = 0
+    pivot["Total"] = pivot.sum(axis=1)
+    pivot = pivot.reset_index()
+    pivot["Shift"] = pivot["Shift"].map(SHIFT_LABEL_MAP)
+    meta = {**meta, "category_counts": category_counts}
+    return pivot, meta
+
+@timed("top_unknowns")
+def top_unknowns(df_work: pd.DataFrame, n=25) -> pd.DataFrame:
+    unk = df_work.loc[df_work["__proc_category__"] == "Other", "__norm__"]
+    if unk.empty:
+        return pd.DataFrame(columns=["normalized_proc", "count"])
+    vc = unk.value_counts()
+    vc = vc[vc > 0].head(n).reset_index()
+    vc.columns = ["normalized_proc", "count"]
+    return vc
+
+@timed("ongoing_stats")
+def ongoing_stats(df_work: pd.DataFrame, completion: CompletionState, now: datetime) -> dict:
+    """เคสที่เหลือ/เสร็จแล้วต่อ category และต่อ shift (bincount บน completion mask) + อัตราและเวลาคาดว่าเสร็จ"""
+    mask = completion.mask
+    cat_names = list(df_work["__proc_category__"].cat.categories)
+    cat_codes = df_work["__proc_category__"].cat.codes.to_numpy()
+    shift_codes = df_work["__shift__"].cat.codes.to_numpy()
+    cat_remaining = np.bincount(cat_codes, minlength=len(cat_names)) - np.bincount(cat_codes[mask], minlength=len(cat_names))
+    remaining_by_category = pd.Series(cat_remaining, index=cat_names)
+    remaining_by_category = remaining_by_category[
+        (remaining_by_category.index != "Other") & (remaining_by_category > 0)
+    ].sort_values(ascending=False, kind="stable")
+    shifts = pd.DataFrame({
+        "shift": SHIFT_ORDER,
+        "total": np.bincount(shift_codes, minlength=len(SHIFT_ORDER)),
+        "done": np.bincount(shift_codes[mask], minlength=len(SHIFT_ORDER)),
+    })
+    shifts["remaining"] = shifts["total"] - shifts["done"]
+    remaining_by_room = None
+    if "__room__" in df_work.columns:
+        room_names = list(df_work["__room__"].cat.categories)
+        room_codes = df_work["__room__"].cat.codes.to_numpy()
+        remaining_by_room = pd.Series(
+            np.bincount(room_codes, minlength=len(room_names)) - np.bincount(room_codes[mask], minlength=len(room_names)),
+            index=room_names,
+        )
+    rate = completion.throughput_per_hour(now)
+    # เคสทำตามลำดับ เช้า -> บ่าย -> TF: เวลาเสร็จของแต่ละ shift คิดจากเคสที่เหลือสะสมถึง shift นั้น
+    if rate:
+        eta_hours = shifts["remaining"].cumsum() / rate
+        shifts["eta"] = pd.Series([
+            (now + dt.timedelta(hours=float(h))) if rem > 0 else None
+            for h, rem in zip(eta_hours, shifts["remaining"])
+        ], dtype=object)
+    else:
+        shifts["eta"] = None
+    return {
+        "remaining_by_category": remaining_by_category,
+        "remaining_by_room": remaining_by_room,
+        "shifts": shifts,
+        "remaining_total": int(len(mask) - mask.sum()),
+        "throughput_per_hour": rate,
+    }
+
+# ===============================
+# ARCHIVE & DAILY ROLLUPS (ประวัติย้อนหลังหลายวัน)
+# ===============================
+SQL_ARCHIVED = "SELECT 1 FROM archived_files WHERE content_hash=? AND rules_version=?"
+SQL_DELETE_ARCHIVE_DAY = "DELETE FROM schedule_archive WHERE op_date=? AND room=?"
+SQL_DELETE_ROLLUP_DAY = "DELETE FROM daily_rollups WHERE op_date=? AND room=?"
+SQL_INSERT_ARCHIVE = """
+    INSERT OR REPLACE INTO schedule_archive
+    (op_date, room, case_key, proc_text, category, shift, mins, content_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_INSERT_ROLLUP = "INSERT INTO daily_rollups (op_date, room, shift, category, n) VALUES (?, ?, ?, ?, ?)"
+SQL_INSERT_ARCHIVED = """
+    INSERT OR REPLACE INTO archived_files
+    (content_hash, rules_version, file_name, archived_at, cases)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_SELECT_ROLLUP_RANGE = """
+    SELECT substr(op_date, 1, ?) AS period, shift, category, SUM(n)
+    FROM daily_rollups
+    WHERE op_date BETWEEN ? AND ?
+    GROUP BY period, shift, category
+"""
+SQL_ROLLUP_DATE_RANGE = "SELECT MIN(op_date), MAX(op_date) FROM daily_rollups"
+
+def daily_rollup(df_work: pd.DataFrame) -> pd.DataFrame:
+    """pivot shift x category ต่อวันที่ผ่าตัด (แบบ long: op_date, shift, category, n) เฉพาะช่องที่ไม่เป็น 0"""
+    counts = df_work.groupby(["__op_date__", "__shift__", "__proc_category__"], observed=True).size()
+    return counts[counts > 0].rename("n").reset_index()
+
+@timed("db.archive_schedule")
+def archive_schedule(
+    df_work: pd.DataFrame, content_hash: str, rules_version: str, file_name: str, room: str = ""
+) -> bool:
+    """บันทึกเคสและ rollup รายวันของไฟล์ลงคลัง (แทนที่ข้อมูลเดิมของวัน+ห้องเดียวกัน) คืน False ถ้าเคยบันทึกแล้ว"""
+    if get_db().fetchone(SQL_ARCHIVED, (content_hash, rules_version)):
+        return False
+    proc_col = pick_text_col(df_work, PROC_COL_CANDIDATES)
+    proc_text = df_work[proc_col].astype(object).where(df_work[proc_col].notna(), None) if proc_col else None
+    mins = df_work["__mins__"].astype(object).where(df_work["__mins__"].notna(), None)
+    archive_rows = zip(
+        df_work["__op_date__"].astype(str),
+        [room] * len(df_work),
+        df_work["__case_key__"].tolist(),
+        proc_text if proc_text is not None else [None] * len(df_work),
+        df_work["__proc_category__"].astype(str),
+        df_work["__shift__"].astype(str),
+        mins,
+        [content_hash] * len(df_work),
+    )
+    rollup = daily_rollup(df_work)
+    rollup_rows = zip(
+        rollup["__op_date__"].astype(str), [room] * len(rollup), rollup["__shift__"].astype(str),
+        rollup["__proc_category__"].astype(str), rollup["n"].tolist(),
+    )
+    with get_db().transaction() as conn:
+        for op_date in df_work["__op_date__"].cat.categories:
+            conn.execute(SQL_DELETE_ARCHIVE_DAY, (str(op_date), room))
+            conn.execute(SQL_DELETE_ROLLUP_DAY, (str(op_date), room))
+        conn.executemany(SQL_INSERT_ARCHIVE, archive_rows)
+        conn.executemany(SQL_INSERT_ROLLUP, rollup_rows)
+        conn.execute(SQL_INSERT_ARCHIVED, (content_hash, rules_version, file_name, datetime.now().isoformat(), len(df_work)))
+    return True
+
+def drop_archived_rooms(rooms: list[str], op_dates: list[str]):
+    """ลบคลังของห้องที่ไม่มีแล้วในวันที่ไฟล์ใหม่ครอบคลุม (เช่นไฟล์หลักเปลี่ยนจาก sheet เดียวเป็นหลาย sheet)"""
+    pairs = [(d, room) for d in op_dates for room in rooms]
+    if not pairs:
+        return
+    with get_db().transaction() as conn:
+        conn.executemany(SQL_DELETE_ARCHIVE_DAY, pairs)
+        conn.executemany(SQL_DELETE_ROLLUP_DAY, pairs)
+
+@process_cache(max_entries=SCHEDULE_CACHE_MAX)
+def ensure_archived(
+    content_hash: str, rules_version: str, file_name: str, _df_work: pd.DataFrame, room: str = ""
+) -> bool:
+    """archive ไฟล์เวอร์ชันนี้ครั้งเดียวต่อ process (ไฟล์ที่มีอยู่ก่อนเปิดใช้คลังก็ถูกบันทึกด้วย)"""
+    return archive_schedule(_df_work, content_hash, rules_version, file_name, room)
+
+def rollup_date_range() -> tuple[str | None, str | None]:
+    return get_db().fetchone(SQL_ROLLUP_DATE_RANGE)
+
+@timed("db.history_summary")
+def history_summary(start: str, end: str, by: str = "month") -> pd.DataFrame:
+    """จำนวนเคสต่อ เดือน/ปี x category จาก daily_rollups (ไม่ต้องอ่านไฟล์เก่า)"""
+    prefix_len = 7 if by == "month" else 4
+    rows = get_db().fetchall(SQL_SELECT_ROLLUP_RANGE, (prefix_len, start, end))
+    long = pd.DataFrame(rows, columns=["period", "shift", "category", "n"])
+    if long.empty:
+        return pd.DataFrame(columns=["period", "Total"])
+    pivot = long.pivot_table(index="period", columns="category", values="n", aggfunc="sum", fill_value=0)
+    cats = [c for c in get_rules().categories if c in pivot.columns]
+    pivot = pivot[cats + [c for c in pivot.columns if c not in cats]]
+    pivot["Total"] = pivot.sum(axis=1)
+    pivot.columns.name = None
+    return pivot.reset_index()
+
+# ===============================
+# MULTI-ROOM SOURCES (หลายไฟล์/หลาย sheet -> enrich พร้อมกันแล้วรวมเป็น frame เดียว)
+# ===============================
+class ScheduleSource(NamedTuple):
+    """ตารางผ่าตัดของห้องหนึ่ง = (ไฟล์, sheet) ที่เนื้อหา hash หนึ่ง"""
+    room: str
+    path: str
+    content_hash: str
+    sheet: str | None = None
+    scope: str | None = None  # ใส่ใน case key/คลัง; None เฉพาะไฟล์หลักแบบ sheet เดียว (key เดิมใช้ต่อได้)
+
+    @property
+    def version(self) -> str:
+        return source_version(self.content_hash, self.sheet)
+
+    @property
+    def label(self) -> str:
+        return os.path.basename(self.path) + (f" [{self.sheet}]" if self.sheet else "")
+
+def workbook_sources(path: str, content_hash: str, stem: str | None = None,
+                     sheets: list[str | None] | None = None) -> list[ScheduleSource]:
+    """แต่ละ sheet ของไฟล์เป็นหนึ่งห้อง (stem=None คือไฟล์หลัก: ชื่อห้อง = ชื่อ sheet)"""
+    out = []
+    for sheet in workbook_sheets(path, content_hash) if sheets is None else sheets:
+        if stem is None:
+            scope = sheet
+            room = sheet or PRIMARY_ROOM_LABEL
+        else:
+            scope = room = stem if sheet is None else f"{stem}/{sheet}"
+        out.append(ScheduleSource(room, path, content_hash, sheet, scope))
+    return out
+
+def discover_sources(primary_path: str, room_dir: str | None = None) -> list[ScheduleSource]:
+    """ไฟล์หลัก + ไฟล์ของแต่ละห้องใน room_dir (ห้องละไฟล์ หรือไฟล์เดียวหลาย sheet)"""
+    sources = []
+    if os.path.exists(primary_path):
+        sources += workbook_sources(primary_path, file_content_hash(primary_path))
+    if room_dir and os.path.isdir(room_dir):
+        for name in sorted(os.listdir(room_dir)):
+            if name.lower().endswith((".xlsx", ".xls")) and not name.startswith("~$"):
+                path = os.path.join(room_dir, name)
+                sources += workbook_sources(path, file_content_hash(path), stem=os.path.splitext(name)[0])
+    return sources
+
+def schedules_version(sources: list[ScheduleSource]) -> str:
+    """version ของชุดข้อมูลรวม (ห้องเดียว = version ของห้องนั้น)"""
+    if len(sources) == 1:
+        return sources[0].version
+    return content_hash_bytes("|".join(f"{s.room}={s.version}" for s in sources).encode("utf-8"))
+
+@process_cache()
+def get_source_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=SOURCE_WORKERS, thread_name_prefix="source")
+
+def prepare_source(source: ScheduleSource, rules_version: str, previous: tuple[pd.DataFrame, dict] | None = None,
+                   file_name: str | None = None, fallback_date: str | None = None) -> tuple[pd.DataFrame, dict]:
+    """enrich + archive ห้องหนึ่ง (cache ตาม version ของห้องนั้นเอง ห้องที่ไม่เปลี่ยนไม่ต้องทำใหม่)
+
+    fallback_date ไม่ส่งมา = วันที่แก้ไขไฟล์ของ source (ไฟล์ที่ยังไม่สลับเข้าที่ต้องส่งวันที่ของไฟล์ staging มาเอง)
+    """
+    if fallback_date is None:
+        fallback_date = file_date(source.path)
+    df_work, meta = get_schedule(
+        source.path, source.content_hash, rules_version, source.sheet, source.scope, fallback_date, _previous=previous
+    )
+    label = source.label if file_name is None else file_name + (f" [{source.sheet}]" if source.sheet else "")
+    ensure_archived(source.version, rules_version, label, df_work, room=source.scope or "")
+    return df_work, meta
+
+@timed("schedule.load_sources")
+def load_sources(sources: list[ScheduleSource], rules_version: str) -> list[tuple[ScheduleSource, pd.DataFrame, dict]]:
+    """เตรียมทุกห้องพร้อมกันบน thread pool"""
+    if len(sources) == 1:
+        loaded = [prepare_source(sources[0], rules_version)]
+    else:
+        loaded = list(get_source_pool().map(lambda src: prepare_source(src, rules_version), sources))
+    return [(src, df, meta) for src, (df, meta) in zip(sources, loaded)]
+
+@process_cache(max_entries=4)
+def combine_schedules(
+    version: str, rules_version: str, _parts: list[tuple[ScheduleSource, pd.DataFrame, dict]]
+) -> tuple[pd.DataFrame, dict]:
+    """รวมทุกห้องเป็น frame เดียว (คอลัมน์ __room__) เรียงตามเวลา ใช้ร่วมกันทุก session ห้ามแก้
+
+    key ด้วย version ของชุดไฟล์ + rules_version: reload กฎแล้วได้ frame ที่ classify ใหม่ ไม่ใช่ของกฎเดิม
+    """
+    rooms = [src.room for src, _, _ in _parts]
+    frames = [df.assign(__room__=pd.Categorical([src.room] * len(df), categories=rooms)) for src, df, _ in _parts]
+    if len(frames) == 1:
+        df = frames[0]
+    else:
+        df = pd.concat(frames, ignore_index=True)
+        # categorical ที่ categories ต่างกันเป็น object หลัง concat -> แปลงกลับ
+        for col in df.columns:
+            if df[col].dtype == object or pd.api.types.is_string_dtype(df[col].dtype):
+                df[col] = df[col].astype("category")
+        mins = df["__mins__"].astype(float).to_numpy()
+        df = df.iloc[np.argsort(mins, kind="stable")].reset_index(drop=True)
+    metas = [meta for _, _, meta in _parts]
+    meta = {
+        "proc_col_used": next((m["proc_col_used"] for m in metas if m["proc_col_used"]), None),
+        "time_col_used": next((m["time_col_used"] for m in metas if m["time_col_used"]), None),
+        "cases_total": len(df),
+        "rules_version": metas[0]["rules_version"],
+        "rooms": rooms,
+        "rows_reused": sum(m["rows_reused"] for m in metas),
+        "rows_enriched": sum(m["rows_enriched"] for m in metas),
+    }
+    return df, meta
+
+def room_breakdown(df_work: pd.DataFrame) -> pd.DataFrame:
+    """จำนวนเคสต่อห้อง x category (+ Total) ด้วย bincount บน categorical codes"""
+    rooms = list(df_work["__room__"].cat.categories)
+    cats = list(df_work["__proc_category__"].cat.categories)
+    codes = df_work["__room__"].cat.codes.to_numpy().astype(np.int64) * len(cats) \
+        + df_work["__proc_category__"].cat.codes.to_numpy()
+    counts = np.bincount(codes, minlength=len(rooms) * len(cats)).reshape(len(rooms), len(cats))
+    table = pd.DataFrame(counts, index=pd.Index(rooms, name="ห้อง"), columns=cats)
+    table = table.loc[:, (table > 0).any(axis=0)]
+    table["Total"] = counts.sum(axis=1)
+    return table.reset_index()
+
+# ===============================
+# DATE PARTITIONS (ไฟล์ตารางล่วงหน้าหลายวัน)
+# ===============================
+@process_cache(max_entries=4)
+def partition_by_date(
+    version: str, rules_version: str, _df_work: pd.DataFrame, _meta: dict
+) -> dict[str, tuple[pd.DataFrame, dict]]:
+    """แบ่ง frame ตามวันที่ผ่าตัดครั้งเดียวต่อ version + rules_version เรียงตามวันที่ (เปลี่ยนวันแค่หยิบ partition ไม่ scan/classify ใหม่)"""
+    op = _df_work["__op_date__"]
+    days = [str(d) for d in op.cat.categories]
+    if len(days) <= 1:
+        return {day: (_df_work, _meta) for day in days}
+    codes = op.cat.codes.to_numpy()
+    # stable: ภายในวันเดียวกันคงลำดับตามเวลาเดิม
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(days) + 1))
+    parts = {}
+    for i, day in enumerate(days):
+        rows = order[bounds[i]:bounds[i + 1]]
+        if len(rows) == 0:
+            continue
+        part = _df_work.iloc[rows].reset_index(drop=True)
+        part["__op_date__"] = part["__op_date__"].cat.remove_unused_categories()
+        parts[day] = (part, {**_meta, "cases_total": len(part)})
+    return parts
+
+def default_op_date(days: list[str], today: str) -> str | None:
+    """วันที่เปิดหน้าครั้งแรก: วันนี้ถ้ามีในไฟล์ ไม่งั้นวันถัดไปที่ใกล้ที่สุด (ไฟล์ย้อนหลังทั้งหมดใช้วันสุดท้าย)
+
+    ไม่มีเคสเลย (ไฟล์มีแต่หัวคอลัมน์) คืน None
+    """
+    if not days:
+        return None
+    upcoming = [d for d in days if d >= today]
+    return upcoming[0] if upcoming else days[-1]
+
+# ===============================
+# BACKGROUND INGEST (อัปโหลด -> เตรียมข้อมูลเบื้องหลัง -> สลับไฟล์แบบ atomic)
+# ===============================
+class IngestJob:
+    """เตรียมไฟล์ที่อัปโหลดให้พร้อม (parse, ตรวจสอบ, enrich, cache) ก่อนสลับเป็นไฟล์ที่ใช้งาน"""
+
+    def __init__(self, content_hash: str, file_name: str, staging_path: str, upload_id: str | None = None):
+        self.content_hash = content_hash
+        self.file_name = file_name
+        self.staging_path = staging_path
+        self.upload_id = upload_id
+        self.state = "queued"  # queued -> running -> ready | failed
+        self.progress = 0.0
+        self.message = "รอคิว"
+        self.error: str | None = None
+        self.rows_reused = 0
+        self.rows_enriched = 0
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("ready", "failed")
+
+    def _step(self, progress: float, message: str):
+        self.progress, self.message = progress, message
+
+    def run(self, target_path: str):
+        self.state = "running"
+        try:
+            self._step(0.1, "กำลังอ่านไฟล์ Excel")
+            frames = read_schedule_workbook(self.staging_path)
+            self._step(0.4, "กำลังตรวจสอบข้อมูล")
+            for sheet, df in frames.items():
+                where = f" (sheet {sheet})" if sheet else ""
+                if len(df.columns) == 0:
+                    raise ValueError(f"ไม่พบคอลัมน์ที่ dashboard ใช้ (เช่น icd9cm_name, estmtime){where}")
+                if len(df) == 0:
+                    raise ValueError(f"ไฟล์ไม่มีรายการผ่าตัด{where}")
+            write_sheet_list(self.content_hash, list(frames))
+            for sheet, df in frames.items():
+                write_sidecar(df, source_version(self.content_hash, sheet))
+            self._step(0.6, "กำลังจัดหมวดหมู่หัตถการและบันทึกลงคลัง")
+            rules_version = get_rules().version
+            sources = workbook_sources(target_path, self.content_hash, sheets=list(frames))
+            old_sources = {}
+            if os.path.exists(target_path):
+                # diff กับไฟล์ที่ใช้อยู่ (sheet เดียวกัน): classify เฉพาะเคสใหม่/ที่แก้ สถานะเสร็จแล้วตาม case key ไปเอง
+                old_sources = {src.sheet: src for src in workbook_sources(target_path, file_content_hash(target_path))}
+
+            # os.replace คง mtime ของไฟล์ staging: วันที่ของไฟล์ใหม่หลังสลับคือวันที่ของ staging ไม่ใช่ของไฟล์เดิม
+            staged_date = file_date(self.staging_path)
+
+            def prepare(src: ScheduleSource):
+                old = old_sources.get(src.sheet)
+                previous = prepare_source(old, rules_version) if old is not None else None
+                return prepare_source(src, rules_version, previous, self.file_name, staged_date)
+
+            prepared = list(get_source_pool().map(prepare, sources))
+            metas = [meta for _, meta in prepared]
+            gone = [src.scope or "" for src in old_sources.values() if src.sheet not in frames]
+            drop_archived_rooms(gone, sorted({str(d) for df, _ in prepared for d in df["__op_date__"].cat.categories}))
+            self.rows_reused = sum(m["rows_reused"] for m in metas)
+            self.rows_enriched = sum(m["rows_enriched"] for m in metas)
+            self._step(0.9, "กำลังสลับเป็นไฟล์ใหม่")
+            # rename เป็น atomic: ผู้ใช้คนอื่นเห็นไฟล์เก่าหรือไฟล์ใหม่ครบทั้งไฟล์เท่านั้น
+            os.replace(self.staging_path, target_path)
+            self._step(1.0, f"พร้อมใช้งาน (เคสเดิม {self.rows_reused}, ใหม่/แก้ไข {self.rows_enriched})")
+            self.state = "ready"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+            try:
+                os.remove(self.staging_path)
+            except OSError:
+                pass
+
+class IngestManager:
+    """งาน ingest ของทั้ง process (งานล่าสุดต่อ hash ของไฟล์)"""
+
+    def __init__(self):
+        self.jobs: dict[str, IngestJob] = {}
+        self.latest: IngestJob | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, data: bytes, file_name: str, target_path: str, upload_id: str | None = None) -> IngestJob:
+        """เริ่ม ingest ไฟล์ (ผู้เรียกส่งมาเฉพาะเมื่อ hash ต่างจากไฟล์ที่ใช้อยู่)
+
+        upload_id คือการอัปโหลดครั้งหนึ่ง (file_id ของ st.file_uploader) การอัปโหลดเดิมที่ค้างอยู่ใน widget
+        ไม่ทำซ้ำทุก rerun แต่อัปโหลดใหม่ด้วยไฟล์เดิม (เช่น A -> B -> A หรือไฟล์ที่เคยไม่ผ่าน) เริ่มงานใหม่
+        """
+        content_hash = content_hash_bytes(data)
+        with self._lock:
+            job = self.jobs.get(content_hash)
+            if job is not None and (not job.done or job.upload_id == upload_id):
+                return job
+            os.makedirs(SIDECAR_DIR, exist_ok=True)
+            staging = os.path.join(SIDECAR_DIR, f"incoming_{content_hash}")
+            with open(staging + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(staging + ".tmp", staging)
+            job = IngestJob(content_hash, file_name, staging, upload_id)
+            self.jobs[content_hash] = job
+            self.latest = job
+        threading.Thread(target=job.run, args=(target_path,), name=f"ingest-{content_hash[:8]}", daemon=True).start()
+        return job
+
+@process_cache()
+def get_ingest_manager() -> IngestManager:
+    return IngestManager()
+
+# ===============================
+# BACKGROUND EXPORTS (สรุปรายวัน / รายการเคส / Other review เป็นไฟล์ดาวน์โหลด)
+# ===============================
+EXPORT_FORMATS = {
+    # รูปแบบ: (ชื่อปุ่ม, นามสกุลไฟล์, mime)
+    "xlsx": ("Excel (.xlsx)", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("CSV (.zip)", "zip", "application/zip"),
+    "html": ("รายงานสำหรับพิมพ์ (.html)", "html", "text/html"),
+}
+EXPORT_SHEET_TITLES = {
+    "daily_summary": "Daily case summary (เช้า/บ่าย/TF)",
+    "cases": "รายการผ่าตัด (ไม่แสดงชื่อผู้ป่วย/ชื่อแพทย์)",
+    "other_review": "Operation นอกเหนือที่ตั้งค่าไว้ (Other review)",
+}
+
+def _clock_text(mins: pd.Series) -> np.ndarray:
+    m = mins.astype(float).to_numpy()
+    out = np.full(len(m), "", dtype=object)
+    ok = ~np.isnan(m)
+    out[ok] = [f"{int(v) // 60:02d}:{int(v) % 60:02d}" for v in m[ok]]
+    return out
+
+def case_list_export(df_work: pd.DataFrame, meta: dict, mask: np.ndarray, completed_at: np.ndarray) -> pd.DataFrame:
+    """รายการเคสตามลำดับเวลา + สถานะ/เวลาที่เสร็จ (มีเฉพาะคอลัมน์หัตถการ/โน้ต ไม่มีข้อมูลผู้ป่วย)"""
+    out = pd.DataFrame({"#": np.arange(len(df_work))})
+    if "__room__" in df_work.columns and df_work["__room__"].cat.categories.size > 1:
+        out["ห้อง"] = df_work["__room__"].astype(str).to_numpy()
+    out["เวลา"] = _clock_text(df_work["__mins__"])
+    out["Shift"] = df_work["__shift__"].map(SHIFT_LABEL_MAP).astype(str).to_numpy()
+    if meta.get("proc_col_used"):
+        out["Operation"] = df_work[meta["proc_col_used"]].astype(object).to_numpy()
+    note_col = pick_text_col(df_work, NOTE_COL_CANDIDATES)
+    if note_col:
+        out["Proc note"] = df_work[note_col].astype(object).to_numpy()
+    out["Category"] = df_work["__proc_category__"].astype(str).to_numpy()
+    out["สถานะ"] = np.where(mask, "เสร็จแล้ว", "ยังไม่เสร็จ")
+    done_at = pd.Series(completed_at).dt.strftime("%H:%M")
+    out["เวลาเสร็จ"] = done_at.fillna("").to_numpy(dtype=object)
+    return out
+
+def export_tables(df_work: pd.DataFrame, meta: dict, mask: np.ndarray, completed_at: np.ndarray) -> dict[str, pd.DataFrame]:
+    summary, _ = build_daily_summary(df_work, meta)
+    active = [c for c in get_rules().categories if c in summary.columns and (summary[c] > 0).any()]
+    return {
+        "daily_summary": summary[["Shift"] + active + ["Total"]],
+        "cases": case_list_export(df_work, meta, mask, completed_at),
+        "other_review": top_unknowns(df_work, n=len(df_work)),
+    }
+
+@timed("export.render")
+def render_export(tables: dict[str, pd.DataFrame], fmt: str, title: str) -> bytes:
+    buf = io.BytesIO()
+    if fmt == "xlsx":
+        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+            for name, table in tables.items():
+                table.to_excel(writer, sheet_name=name, index=False)
+    elif fmt == "csv":
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name, table in tables.items():
+                zf.writestr(f"{name}.csv", table.to_csv(index=False).encode("utf-8-sig"))
+    elif fmt == "html":
+        sections = "".join(
+            f"<h2>{html.escape(EXPORT_SHEET_TITLES.get(name, name))}</h2>{table.to_html(index=False, na_rep='')}"
+            for name, table in tables.items()
+        )
+        buf.write((
+            f"<!DOCTYPE html><html lang='th'><head><meta charset='utf-8'><title>{html.escape(title)}</title>"
+            "<style>body{font-family:sans-serif;font-size:12px}table{border-collapse:collapse;margin-bottom:16px}"
+            "th,td{border:1px solid #999;padding:2px 6px}h2{font-size:15px;margin-top:20px}"
+            "@media print{h2{page-break-after:avoid}tr{page-break-inside:avoid}}</style></head>"
+            f"<body><h1>{html.escape(title)}</h1>{sections}</body></html>"
+        ).encode("utf-8"))
+    else:
+        raise ValueError(f"ไม่รู้จักรูปแบบ export: {fmt}")
+    return buf.getvalue()
+
+class ExportJob:
+    """สร้างไฟล์ export หนึ่งไฟล์บน thread เบื้องหลัง (ผลเก็บไว้ให้ทุก session ดาวน์โหลดซ้ำได้)"""
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.state = "queued"  # queued -> running -> ready | failed
+        self.data: bytes | None = None
+        self.error: str | None = None
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def run(self, build):
+        self.state = "running"
+        try:
+            self.data = build()
+            self.state = "ready"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+        finally:
+            self._done.set()
+
+class ExportManager:
+    """ไฟล์ export ของทั้ง process (หนึ่งงานต่อ key: version ไฟล์, วันที่, token สถานะ, รูปแบบ) แบบ LRU"""
+
+    def __init__(self, max_entries: int = EXPORT_CACHE_MAX):
+        self.max_entries = max_entries
+        self.jobs: OrderedDict[tuple, ExportJob] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+        self.hits = 0
+        self.misses = 0
+
+    def request(self, key: tuple, build) -> ExportJob:
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is not None:
+                self.jobs.move_to_end(key)
+                self.hits += 1
+                return job
+            self.misses += 1
+            job = ExportJob(key)
+            self.jobs[key] = job
+            while len(self.jobs) > self.max_entries:
+                self.jobs.popitem(last=False)
+        self._pool.submit(job.run, build)
+        return job
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0, "entries": len(self.jobs)}
+
+@process_cache()
+def get_export_manager() -> ExportManager:
+    return ExportManager()
+
+def request_exports(version: str, op_date: str, df_work: pd.DataFrame, meta: dict,
+                    completion: CompletionState) -> dict[str, ExportJob]:
+    """งาน export ทุกรูปแบบของวันนี้ที่สถานะปัจจุบัน (มีอยู่แล้วได้ไฟล์เดิม ไม่สร้างใหม่ทุก rerun)"""
+    token, mask, completed_at = completion.snapshot()
+    key = (version, op_date, meta.get("rules_version"), token)
+    title = f"OR-minor schedule {op_date}"
+    tables: dict[str, pd.DataFrame] = {}
+    tables_lock = threading.Lock()
+
+    def build(fmt: str):
+        def run() -> bytes:
+            # ตารางสร้างครั้งเดียวใช้ร่วมทุกรูปแบบของ key เดียวกัน
+            with tables_lock:
+                if not tables:
+                    tables.update(export_tables(df_work, meta, mask, completed_at))
+            return render_export(tables, fmt, title)
+        return run
+
+    manager = get_export_manager()
+    return {fmt: manager.request(key + (fmt,), build(fmt)) for fmt in EXPORT_FORMATS}
@@ -1,60 +1,17 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
 import datetime as dt
-import re
-import sqlite3
 import os
-from datetime import datetime
+import time
 
 # ===============================
-# SHARED EXCEL + SQLITE SETUP
+# DASHBOARD SETTINGS (ส่วนประมวลผลอยู่ใน or_core.py)
 # ===============================
 SHARED_EXCEL_PATH = "shared_schedule.xlsx"  # ไฟล์ที่ทุกคนใช้ร่วมกัน
-DB_PATH = "or_dashboard.db"
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS completed_cases (
-            upload_date TEXT,
-            file_name TEXT,
-            case_index INTEGER,
-            completed_at TEXT,
-            PRIMARY KEY (upload_date, file_name, case_index)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def load_completed_cases(upload_date: str, file_name: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT case_index FROM completed_cases WHERE upload_date=? AND file_name=?", (upload_date, file_name))
-    rows = c.fetchall()
-    conn.close()
-    return {row[0] for row in rows}
-
-def mark_completed(upload_date: str, file_name: str, case_index: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        INSERT OR IGNORE INTO completed_cases
-        (upload_date, file_name, case_index, completed_at)
-        VALUES (?, ?, ?, ?)
-    """, (upload_date, file_name, case_index, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-
-def reset_completed_cases(upload_date: str, file_name: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM completed_cases WHERE upload_date=? AND file_name=?", (upload_date, file_name))
-    conn.commit()
-    conn.close()
-
-init_db()
+ROOM_SCHEDULE_DIR = "room_schedules"  # ไฟล์ตารางของห้องอื่น (ห้องละไฟล์) รวมแสดงกับไฟล์หลัก
+CASE_PAGE_SIZES = [25, 50, 100, 200]  # จำนวนเคสต่อหน้าในรายการผ่าตัดวันนี้
+LIVE_REFRESH_SECONDS = 10  # ความถี่ที่ fragment สถานะเช็ค change token ใน DB
+EXPORT_WAIT_SECONDS = 0.5  # รอไฟล์ export ที่ยังสร้างไม่เสร็จได้นานสุดต่อ rerun (รวมทุกรูปแบบ)
+PROMETHEUS_TEXTFILE = os.environ.get("OR_DASHBOARD_PROMETHEUS_FILE")  # ถ้าตั้งไว้ เขียน metrics แบบ Prometheus ทุกรอบ
 
 # ===============================
 # CONFIG
@@ -62,6 +19,14 @@ init_db()
 st.set_page_config(page_title="OR-minor Schedule Dashboard", layout="wide")
 st.markdown("<h1 style='font-size:34px; margin-bottom: 0.2rem;'>OR-minor Schedule Dashboard 📊</h1>", unsafe_allow_html=True)
 
+THAI_MONTH_NAMES = ["", "มกราคม", "กุมภาพันธ์", "มีนาคม", "เมษายน", "พฤษภาคม", "มิถุนายน",
+                    "กรกฎาคม", "สิงหาคม", "กันยายน", "ตุลาคม", "พฤศจิกายน", "ธันวาคม"]
+
+def thai_date(day: str) -> str:
+    """YYYY-MM-DD -> วันที่แบบไทย (พ.ศ.)"""
+    d = dt.date.fromisoformat(day)
+    return f"{d.day} {THAI_MONTH_NAMES[d.month]} {d.year + 543}"
+
 def small_divider(width_pct: int = 55, thickness_px: int = 2, color: str = "#e0e0e0", margin_px: int = 12):
     st.markdown(f"<div style='width: {width_pct}%; margin: {margin_px}px auto; border-bottom: {thickness_px}px solid {color};'></div>", unsafe_allow_html=True)
 
@@ -90,6 +55,21 @@ if not st.session_state["authenticated"]:
                 st.error("รหัสผ่านไม่ถูกต้อง")
     st.stop()
 
+# pandas / numpy / or_core โหลดหลังผ่านหน้า login: process ใหม่แสดงหน้า login ได้ทันทีโดยไม่ต้องรอ import
+import pandas as pd  # noqa: E402
+import numpy as np  # noqa: E402
+from or_core import (  # noqa: E402
+    EXPORT_FORMATS, SHIFT_LABEL_MAP, THROUGHPUT_WINDOW_MINUTES, IngestJob, build_daily_summary, cache_stats,
+    combine_schedules, content_hash_bytes, default_op_date, discover_sources, ensure_legacy_migrated,
+    file_content_hash, frame_memory_mb, fuzzy_categories, get_classification_cache, get_ingest_manager,
+    get_rules, get_rules_holder, get_timings, history_summary, load_sources, mark_completed_many, memory_report,
+    ongoing_stats, partition_by_date, request_exports, reset_completed_cases, rollup_date_range, room_breakdown,
+    schedules_version, sync_completed_cases, timed, top_unknowns, unmark_completed_many,
+)
+
+timings = get_timings()
+rerun_t0 = time.perf_counter()
+
 # ===============================
 # TOP BAR
 # ===============================
@@ -98,13 +78,22 @@ with top_c1:
     if st.button("🔄 Refresh"):
         st.rerun()
 with top_c2:
-    st.caption("ℹ️ กด Refresh เพื่ออัปเดต")
+    st.caption(f"ℹ️ สถานะเคสอัปเดตอัตโนมัติทุก {LIVE_REFRESH_SECONDS} วินาที กด Refresh เพื่อโหลดใหม่ทั้งหน้า")
 with top_c3:
     if st.button("ออกจากระบบ"):
         st.session_state["authenticated"] = False
         st.rerun()
 small_divider(70, 2, "#e6e6e6", 10)
 
+# ===============================
+# Helper: dataframe width compat
+# ===============================
+def df_show(df, stretch: bool = True):
+    try:
+        return st.dataframe(df, width=("stretch" if stretch else "content"))
+    except TypeError:
+        return st.dataframe(df, use_container_width=stretch)
+
 # ===============================
 # SIDEBAR: SHARED UPLOAD (Admin only)
 # ===============================
@@ -122,288 +111,130 @@ with st.sidebar:
         type=["xlsx", "xls"],
         key="uploader"
     )
+    ingest = get_ingest_manager()
     if uploaded_file is not None:
-        with open(SHARED_EXCEL_PATH, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        st.success(f"อัปโหลดสำเร็จ: {uploaded_file.name}")
-        st.rerun()
+        data = uploaded_file.getvalue()
+        new_hash = content_hash_bytes(data)
+        current_hash = file_content_hash(SHARED_EXCEL_PATH) if os.path.exists(SHARED_EXCEL_PATH) else None
+        if new_hash != current_hash:
+            # เตรียมข้อมูลเบื้องหลัง ระหว่างนี้ทุกคนยังใช้ไฟล์เดิม
+            ingest.submit(data, uploaded_file.name, SHARED_EXCEL_PATH, uploaded_file.file_id)
+        elif ingest.jobs.get(new_hash) is not None:
+            done_job = ingest.jobs[new_hash]
+            st.success(
+                f"อัปโหลดสำเร็จ: {uploaded_file.name}\n\n"
+                f"เคสเดิม {done_job.rows_reused} ราย (คงสถานะเดิม), ใหม่/แก้ไข {done_job.rows_enriched} ราย"
+            )
+
+    @st.fragment(run_every=1)
+    def render_ingest_progress(job: IngestJob):
+        if job.done:
+            st.rerun()
+        st.progress(job.progress, text=f"⏳ {job.file_name}: {job.message}")
+
+    job = ingest.latest
+    if job is not None and not job.done:
+        render_ingest_progress(job)
+    elif job is not None and job.state == "failed" and uploaded_file is not None:
+        st.error(f"ใช้ไฟล์ {job.file_name} ไม่ได้ ยังใช้ไฟล์เดิมอยู่: {job.error}")
 
 # ===============================
-# อ่านไฟล์ shared
+# อ่านไฟล์ shared (+ ไฟล์ของห้องอื่น)
 # ===============================
-if not os.path.exists(SHARED_EXCEL_PATH):
-    st.info("🔒 รอ Admin อัปโหลดไฟล์ Excel ก่อนใช้งาน")
-    st.stop()
-
 try:
-    df_raw = pd.read_excel(SHARED_EXCEL_PATH)
-except Exception as e:
+    with timings.span("file.hash"):
+        sources = discover_sources(SHARED_EXCEL_PATH, ROOM_SCHEDULE_DIR)
+except OSError as e:
     st.error(f"อ่านไฟล์ไม่ได้: {e}")
     st.stop()
+if not sources:
+    st.info("🔒 รอ Admin อัปโหลดไฟล์ Excel ก่อนใช้งาน")
+    st.stop()
+schedule_hash = schedules_version(sources)
+multi_room = len(sources) > 1
 
-# เวลาอัปโหลดไฟล์ (สำหรับ DB key)
-upload_ts = dt.datetime.fromtimestamp(os.stat(SHARED_EXCEL_PATH).st_mtime)
-upload_date_str = upload_ts.strftime("%Y-%m-%d")
+# เวลาอัปโหลดไฟล์ล่าสุด (แสดงในแถบสถานะ)
+upload_ts = dt.datetime.fromtimestamp(max(os.stat(src.path).st_mtime for src in sources))
 active_file_name = "shared_schedule.xlsx"
 
-# โหลด completed cases
-completed_set = load_completed_cases(upload_date_str, active_file_name)
-st.session_state["completed_cases"] = completed_set
-
 # แปลงเวลา พ.ศ.
 year_th = upload_ts.year + 543
 year_short = year_th % 100
 upload_time_str = f"{upload_ts.day:02d}/{upload_ts.month:02d}/{year_short:02d} {upload_ts.strftime('%H:%M')}"
 
 # ===============================
-# Helper: dataframe width compat
-# ===============================
-def df_show(df, stretch: bool = True):
-    try:
-        return st.dataframe(df, width=("stretch" if stretch else "content"))
-    except TypeError:
-        return st.dataframe(df, use_container_width=stretch)
-
-# ===============================
-# Shift labels
-# ===============================
-SHIFT_ORDER = ["AM", "PM", "Unknown"]
-SHIFT_LABEL_MAP = {"AM": "เช้า", "PM": "บ่าย", "Unknown": "TF"}
-
-# ===============================
-# COLUMN PICKER
-# ===============================
-def pick_text_col(df: pd.DataFrame, candidates: list[str]) -> str | None:
-    cols = {str(c).strip().lower(): str(c).strip() for c in df.columns}
-    for c in candidates:
-        if c.lower() in cols:
-            return cols[c.lower()]
-    return None
-
-# ===============================
-# PROCEDURE CATEGORIES & ALIASES
-# ===============================
-PROC_CATEGORIES = [
-    "I+D", "Excision", "Nail extraction", "Off perm/catheter", "Lymphnode biopsy",
-    "Debridement", "EC", "Frenectomy", "Morpheus", "Cooltech", "Laser",
-    "Eyelid correction", "Facelift", "Other",
-]
-
-ALIASES = {
-    "i&d": "i+d", "i/d": "i+d", "i d": "i+d", "i and d": "i+d", "i n d": "i+d",
-    "incision and drainage": "incision drainage", "incision & drainage": "incision drainage",
-    "incision drainage": "incision drainage",
-    "debridement": "debridement", "debride": "debridement", "debrided": "debridement",
-    "db": "debridement", "d/b": "debridement", "d&b": "debridement",
-    "excisional debridement": "debridement",
-    "off permanent catheter": "off perm", "off perm cath": "off perm",
-    "off perm catheter": "off perm", "off cath": "off perm", "off tcc": "off perm",
-    "e.c.": "ec", "e. c.": "ec", "e c": "ec", "ec.": "ec", "ec,": "ec", "ec;": "ec",
-    "blepharoptosis repair": "ptosis correction",
-    "correction of blepharoptosis": "ptosis correction",
-    "upper eyelid ptosis repair": "ptosis correction",
-    "upper lid ptosis correction": "ptosis correction",
-    "eyelid ptosis correction": "ptosis correction",
-    "ptosis repair": "ptosis correction",
-    "ptosis surgery": "ptosis correction",
-    "levator advancement": "ptosis correction",
-    "levator aponeurosis advancement": "ptosis correction",
-    "levator resection": "ptosis correction",
-    "levator plication": "ptosis correction",
-    "frontalis sling": "ptosis correction",
-    "frontalis suspension": "ptosis correction",
-    "upper eyelid correction": "ptosis correction",
-    'incisional biopsy':'excision',
-    'incision biopsy':'excision',
-    'incision':'excison'
-}
-
-def normalize_proc_text(x: str) -> str:
-    if pd.isna(x):
-        return ""
-    s = str(x).lower().strip()
-    s = s.replace("\u00a0", " ")
-    s = re.sub(r"\s+", " ", s)
-    s = re.sub(r"\be\s*[\.\-\s]\s*c\b", "ec", s)
-    for k, v in ALIASES.items():
-        s = s.replace(k, v)
-    s = re.sub(r"\bi\s*(?:\+|&|\band\b)\s*d\b", "i+d", s)
-    s = re.sub(r"\bincision\s*(?:&|\band\b)?\s*drainage\b", "incision drainage", s)
-    s = re.sub(r"[,\.;:\(\)\[\]\{\}]", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
-def classify_proc_category_rules(proc_text: str) -> str:
-    s = normalize_proc_text(proc_text)
-    if ("i+d" in s) or ("incision drainage" in s):
-        return "I+D"
-    if re.search(r"\bexcis", s):
-        return "Excision"
-    if re.search(r"\bnail\s*(extraction|extract|ext)\b", s):
-        return "Nail extraction"
-    if re.search(r"\boff\s*perm\b", s) or re.search(r"\boff\s*catheter\b", s):
-        return "Off perm/catheter"
-    if re.search(r"\blymph\s*node\s*biopsy\b", s) or re.search(r"\blymphnode\s*biopsy\b", s) or re.search(r"\bln\s*biopsy\b", s):
-        return "Lymphnode biopsy"
-    if re.search(r"\bdebrid", s):
-        return "Debridement"
-    if re.search(r"(?<![a-z0-9])ec(?![a-z0-9])", s):
-        return "EC"
-    if re.search(r"\bfrenectomy\b", s) or re.search(r"\bfrenulectomy\b", s):
-        return "Frenectomy"
-    if re.search(r"\bmorpheus\b", s):
-        return "Morpheus"
-    if re.search(r"\bcooltech\b", s) or re.search(r"\bcool\s*tech\b", s):
-        return "Cooltech"
-    if re.search(r"\blaser\b", s):
-        return "Laser"
-    if re.search(r"\bptosis\b", s) or re.search(r"\bblepharoptosis\b", s):
-        return "Eyelid correction"
-    if re.search(r"\bfacelift\b", s) or re.search(r"\bface\s*lift\b", s) or re.search(r"\brhytidectomy\b", s):
-        return "Facelift"
-    if re.search(r"\bincision(al)?\s*biopsy\b", s):
-        return "Excision"
-    if re.search(r"\bincision(al)?\b", s):  # จับ incision อย่างเดียวด้วย
-        return "Excision"
-    return "Other"
-
-def classify_proc_category(proc_text: str, use_fuzzy: bool = False, threshold: int = 85) -> str:
-    base = classify_proc_category_rules(proc_text)
-    if (not use_fuzzy) or (base != "Other"):
-        return base
-    try:
-        from rapidfuzz import process, fuzz
-    except Exception:
-        return base
-    s = normalize_proc_text(proc_text)
-    if not s:
-        return "Other"
-    CANON = {
-        "I+D": ["i+d", "incision drainage"],
-        "Excision": ["excision"],
-        "Nail extraction": ["nail extraction"],
-        "Off perm/catheter": ["off perm", "off catheter"],
-        "Lymphnode biopsy": ["lymph node biopsy", "ln biopsy"],
-        "Debridement": ["debridement"],
-        "EC": ["ec"],
-        "Frenectomy": ["frenectomy"],
-        "Morpheus": ["morpheus"],
-        "Cooltech": ["cooltech"],
-        "Laser": ["laser"],
-        "Eyelid correction": ["ptosis correction", "eyelid correction"],
-        "Facelift": ["facelift"],
-    }
-    all_choices = [(cat, term) for cat, terms in CANON.items() for term in terms]
-    choices = [term for _, term in all_choices]
-    best = process.extractOne(s, choices, scorer=fuzz.token_set_ratio)
-    if best and best[1] >= threshold:
-        return all_choices[best[2]][0]
-    return "Other"
-
-# ===============================
-# TIME PARSING
+# MAIN CONTENT: วันที่ผ่าตัด (ใช้ estmdate แทน opedate)
 # ===============================
-def to_minutes_from_any(x):
-    if pd.isna(x):
-        return np.nan
-    try:
-        xi = int(float(x))
-        hh, mm = xi // 100, xi % 100
-        if 0 <= hh <= 23 and 0 <= mm <= 59:
-            return hh * 60 + mm
-    except Exception:
-        pass
-    try:
-        s = str(x).strip()
-        m = re.match(r"^(\d{1,2}):(\d{2})$", s)
-        if m:
-            hh, mm = int(m.group(1)), int(m.group(2))
-            if 0 <= hh <= 23 and 0 <= mm <= 59:
-                return hh * 60 + mm
-    except Exception:
-        pass
-    return np.nan
-
-def classify_shift(mins: float) -> str:
-    if pd.isna(mins):
-        return "Unknown"
-    return "AM" if mins < 12 * 60 else "PM"
+rules_version = get_rules().version
+try:
+    with timings.span("schedule.get"):
+        # ทุกห้อง enrich พร้อมกัน (ห้องที่ไฟล์ไม่เปลี่ยนได้จาก cache ทันที) แล้วรวมเป็น frame เดียว
+        schedule_parts = load_sources(sources, rules_version)
+        df_enriched, enrich_meta = combine_schedules(schedule_hash, rules_version, schedule_parts)
+except Exception as e:
+    st.error(f"อ่านไฟล์ไม่ได้: {e}")
+    st.stop()
 
-# ===============================
-# BUILD SUMMARY
-# ===============================
-def build_daily_summary(df_raw_in: pd.DataFrame, use_fuzzy: bool, fuzzy_threshold: int):
-    df = df_raw_in.copy()
-    df.columns = [str(c).strip() for c in df.columns]
-    df_work = df.copy()
-    proc_col = pick_text_col(df_work, ["icd9cm_name", "operation", "opname", "procedure", "proc", "หัตถการ", "ผ่าตัด"])
-    time_col = pick_text_col(df_work, ["estmtime", "reqtime", "opetime", "time", "เวลา", "เวลาผ่า", "เวลาเริ่ม"])
-    if proc_col is None:
-        df_work["__proc_category__"] = "Other"
-    else:
-        df_work["__proc_category__"] = df_work[proc_col].apply(
-            lambda v: classify_proc_category(v, use_fuzzy=use_fuzzy, threshold=fuzzy_threshold)
+with st.sidebar:
+    with st.expander("📦 Memory report"):
+        st.caption(f"frame ที่ใช้อยู่: {len(df_enriched.columns)} คอลัมน์, {frame_memory_mb(df_enriched):.3f} MB")
+        if st.button("เทียบกับการอ่านทุกคอลัมน์", key="memory_report_btn", disabled=multi_room):
+            df_show(memory_report(SHARED_EXCEL_PATH, df_enriched))
+    with st.expander("⏱️ Performance"):
+        st.caption("เวลาแต่ละขั้นตอน (ms) จาก span ล่าสุดของทั้ง process")
+        df_show(timings.summary())
+        hit_rates = pd.DataFrame(cache_stats()).T.astype({"hits": int, "misses": int, "entries": int})
+        hit_rates["hit_rate"] = hit_rates["hit_rate"].astype(float).round(3)
+        df_show(hit_rates)
+        st.download_button(
+            "ดาวน์โหลด metrics (Prometheus)",
+            timings.prometheus_text(cache_stats()),
+            file_name="or_dashboard.prom",
+            mime="text/plain",
+            key="metrics_download",
         )
-    if time_col is None:
-        df_work["__shift__"] = "Unknown"
-    else:
-        df_work["__mins__"] = df_work[time_col].apply(to_minutes_from_any)
-        df_work["__shift__"] = df_work["__mins__"].apply(classify_shift)
-    category_counts = df_work["__proc_category__"].value_counts()
-    category_counts = category_counts[category_counts.index != "Other"]
-    g = df_work.groupby(["__shift__", "__proc_category__"]).size().reset_index(name="n")
-    pivot = g.pivot(index="__shift__", columns="__proc_category__", values="n").fillna(0).astype(int)
-    for col in PROC_CATEGORIES:
-        if col not in pivot.columns:
-            pivot[col] = 0
-    pivot["Total"] = pivot.sum(axis=1)
-    for sh in SHIFT_ORDER:
-        if sh not in pivot.index:
-            pivot.loc[sh] = 0
-    pivot = pivot.loc[SHIFT_ORDER].reset_index().rename(columns={"__shift__": "Shift"})
-    pivot["Shift"] = pivot["Shift"].map(SHIFT_LABEL_MAP)
-    meta = {
-        "proc_col_used": proc_col,
-        "time_col_used": time_col,
-        "cases_total": len(df_work),
-        "category_counts": category_counts,
-    }
-    return pivot, meta, df_work
-
-def top_unknowns(df_work: pd.DataFrame, proc_col: str, n=25) -> pd.DataFrame:
-    tmp = df_work.copy()
-    tmp["__norm__"] = tmp[proc_col].apply(normalize_proc_text)
-    tmp["__cat__"] = tmp[proc_col].apply(classify_proc_category_rules)
-    unk = tmp[tmp["__cat__"] == "Other"]
-    if unk.empty:
-        return pd.DataFrame(columns=["normalized_proc", "count"])
-    vc = unk["__norm__"].value_counts().head(n).reset_index()
-    vc.columns = ["normalized_proc", "count"]
-    return vc
 
-# ===============================
-# MAIN CONTENT: วันที่ผ่าตัด (ใช้ estmdate แทน opedate)
-# ===============================
 op_date_str = None
 
 # ลองดึงจาก estmdate ก่อน (วันที่คาดการณ์)
 date_col = None
-if "estmdate" in df_raw.columns:
+if "estmdate" in df_enriched.columns:
     date_col = "estmdate"
-elif "opedate" in df_raw.columns:  # fallback ถ้าไม่มี estmdate
+elif "opedate" in df_enriched.columns:  # fallback ถ้าไม่มี estmdate
     date_col = "opedate"
 
+# ไฟล์ล่วงหน้าหลายวัน: แบ่งตาม __op_date__ ครั้งเดียวต่อ version แล้วเลือกดูทีละวัน
+# สถานะแบบเดิมอ้างเลขแถวของไฟล์หลัก (sheet แรก) กับวันที่แก้ไขไฟล์หลัก ไม่ใช่ frame ที่รวมทุกห้อง
+primary_src, primary_df, _ = schedule_parts[0]
+if primary_src.path == SHARED_EXCEL_PATH:
+    primary_upload_date = dt.date.fromtimestamp(os.stat(primary_src.path).st_mtime).isoformat()
+    ensure_legacy_migrated(primary_src, primary_upload_date, active_file_name, primary_df)
+day_partitions = partition_by_date(schedule_hash, rules_version, df_enriched, enrich_meta)
+op_days = list(day_partitions)
+selected_day = default_op_date(op_days, dt.date.today().isoformat())
+if selected_day is None:
+    # ไฟล์ที่ใช้อยู่ (หรือทุกห้อง) มีแต่หัวคอลัมน์ ไม่มีรายการผ่าตัด
+    st.info("ไม่มีข้อมูลรายการผ่าตัดในไฟล์ที่ใช้อยู่")
+    st.stop()
+if len(op_days) > 1:
+    d1, d2 = st.columns([1, 3])
+    with d1:
+        selected_day = st.selectbox(
+            f"วันที่ผ่าตัด ({len(op_days)} วันในไฟล์)",
+            op_days,
+            index=op_days.index(selected_day),
+            format_func=lambda d: f"{thai_date(d)} ({len(day_partitions[d][0])} เคส)",
+            key="op_date",
+        )
+df_day, day_meta = day_partitions[selected_day]
+# เริ่มสร้างไฟล์ export เบื้องหลังตั้งแต่ตอนนี้ ให้เสร็จระหว่างที่หน้าที่เหลือ render (ส่วนดาวน์โหลดอยู่ท้ายหน้า)
+# ส่วนดาวน์โหลดรับ job ชุดนี้ไปใช้ในรอบเดียวกัน ไม่ต้อง sync สถานะซ้ำ
+st.session_state["prefetched_exports"] = request_exports(
+    schedule_hash, selected_day, df_day, day_meta, sync_completed_cases(schedule_hash, selected_day, df_day)
+)
+
 if date_col:
-    date_series = df_raw[date_col].dropna()
-    if not date_series.empty:
-        date_raw = pd.to_datetime(date_series.iloc[0], errors="coerce")
-        if pd.notna(date_raw):
-            day_op = date_raw.day
-            month_op = date_raw.month
-            year_th_op = date_raw.year + 543
-            month_names = ["", "มกราคม", "กุมภาพันธ์", "มีนาคม", "เมษายน", "พฤษภาคม", "มิถุนายน",
-                           "กรกฎาคม", "สิงหาคม", "กันยายน", "ตุลาคม", "พฤศจิกายน", "ธันวาคม"]
-            op_date_str = f"{day_op} {month_names[month_op]} {year_th_op}"
+    op_date_str = thai_date(selected_day)
 
 if op_date_str:
     st.markdown(
@@ -431,9 +262,9 @@ small_divider(width_pct=70, thickness_px=2, color="#eeeeee", margin_px=12)
 # OR SUMMARY
 # ===============================
 st.subheader("📊 OR-Minor Summary")
-summary_df_temp, meta_temp, _ = build_daily_summary(df_raw, use_fuzzy=False, fuzzy_threshold=85)
-total_cases = int(meta_temp["cases_total"])
-category_counts = meta_temp["category_counts"]
+rules_summary_df, rules_meta = build_daily_summary(df_day, day_meta)
+total_cases = int(rules_meta["cases_total"])
+category_counts = rules_meta["category_counts"]
 top_categories = category_counts.sort_values(ascending=False).head(4)
 display_cats = top_categories.index.tolist()
 cols = st.columns(5)
@@ -445,52 +276,67 @@ for i, cat in enumerate(display_cats):
     with cols[i + 1]:
         st.markdown(f"<h4 style='text-align: center; color: black;'>{cat}</h4>", unsafe_allow_html=True)
         st.markdown(f"<h2 style='text-align: center; color: black; margin-top: -10px;'>{count}</h2>", unsafe_allow_html=True)
+if multi_room:
+    with st.expander(f"🏥 แยกตามห้อง ({len(day_meta['rooms'])} ห้อง)"):
+        df_show(room_breakdown(df_day), stretch=True)
 small_divider(70, 2, "#eeeeee", 12)
 
 # ===============================
 # OPERATION ON-GOING
 # ===============================
 st.subheader("⏳ Operation On-going")
-proc_col = pick_text_col(df_raw, ["icd9cm_name", "operation", "opname", "procedure", "proc", "หัตถการ", "ผ่าตัด"])
-if proc_col:
-    df_tmp = df_raw.copy()
-    df_tmp["__proc_category__"] = df_tmp[proc_col].apply(classify_proc_category_rules)
-    completed_by_category = {}
-    for idx in st.session_state.get("completed_cases", set()):
-        if 0 <= idx < len(df_tmp):
-            cat = df_tmp.iloc[idx]["__proc_category__"]
-            completed_by_category[cat] = completed_by_category.get(cat, 0) + 1
-    ongoing_counts = {}
-    for cat, total in category_counts.items():
-        completed = int(completed_by_category.get(cat, 0))
-        remaining = int(total) - completed
-        if remaining > 0:
-            ongoing_counts[cat] = remaining
-    if ongoing_counts:
-        ongoing_cats = sorted(ongoing_counts.items(), key=lambda x: x[1], reverse=True)
-        ongoing_cols = st.columns(len(ongoing_cats) + 1)
-        with ongoing_cols[0]:
-            st.markdown("<h4 style='text-align: center; color: #2e86de;'>On-going</h4>", unsafe_allow_html=True)
-        for i, (cat, count) in enumerate(ongoing_cats):
-            with ongoing_cols[i + 1]:
-                st.markdown(f"<h4 style='text-align: center; color: black;'>{cat}</h4>", unsafe_allow_html=True)
-                st.markdown(f"<h2 style='text-align: center; color: #e74c3c; margin-top: -10px;'>{count}</h2>", unsafe_allow_html=True)
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+@timed("render.ongoing")
+def render_ongoing():
+    # รันซ้ำเฉพาะส่วนนี้ตามรอบ; โหลดสถานะจาก DB ใหม่เมื่อ change token เปลี่ยนเท่านั้น
+    completion = sync_completed_cases(schedule_hash, selected_day, df_day)
+    now = dt.datetime.now()
+    stats = ongoing_stats(df_day, completion, now)
+    if day_meta["proc_col_used"]:
+        ongoing_cats = list(stats["remaining_by_category"].items())
+        if ongoing_cats:
+            ongoing_cols = st.columns(len(ongoing_cats) + 1)
+            with ongoing_cols[0]:
+                st.markdown("<h4 style='text-align: center; color: #2e86de;'>On-going</h4>", unsafe_allow_html=True)
+            for i, (cat, count) in enumerate(ongoing_cats):
+                with ongoing_cols[i + 1]:
+                    st.markdown(f"<h4 style='text-align: center; color: black;'>{cat}</h4>", unsafe_allow_html=True)
+                    st.markdown(f"<h2 style='text-align: center; color: #e74c3c; margin-top: -10px;'>{count}</h2>", unsafe_allow_html=True)
+        else:
+            st.success("🎉 ไม่มีเคสที่เหลือทำแล้ว")
     else:
-        st.success("🎉 ไม่มีเคสที่เหลือทำแล้ว")
-else:
-    st.info("ไม่พบคอลัมน์หัตถการสำหรับคำนวณ On-going")
-current_time = dt.datetime.now()
-year_th_cur = current_time.year + 543
-year_short_cur = year_th_cur % 100
-current_time_str = f"{current_time.day:02d}/{current_time.month:02d}/{year_short_cur:02d} {current_time.strftime('%H:%M:%S')}"
-remaining_cases = total_cases - len(st.session_state.get("completed_cases", set()))
-status_cols = st.columns(3)
-with status_cols[0]:
-    st.markdown(f"<p style='text-align: left; color: black; margin-top: 20px;'><strong>⏰ เวลาปัจจุบัน:</strong> {current_time_str}</p>", unsafe_allow_html=True)
-with status_cols[1]:
-    st.markdown(f"<p style='text-align: center; color: #666666; margin-top: 20px;'><strong>📤 อัปโหลดเมื่อ:</strong> {upload_time_str}</p>", unsafe_allow_html=True)
-with status_cols[2]:
-    st.markdown(f"<p style='text-align: right; color: #d73a3a; font-weight: bold; margin-top: 20px;'><strong>⏳ เหลือเคสที่ยังไม่เสร็จ:</strong> {remaining_cases} ราย</p>", unsafe_allow_html=True)
+        st.info("ไม่พบคอลัมน์หัตถการสำหรับคำนวณ On-going")
+    if multi_room:
+        st.caption("เหลือต่อห้อง: " + " · ".join(f"{room} {n}" for room, n in stats["remaining_by_room"].items()))
+    shift_rows = stats["shifts"][stats["shifts"]["total"] > 0]
+    if not shift_rows.empty:
+        shift_cols = st.columns(len(shift_rows))
+        for col, row in zip(shift_cols, shift_rows.itertuples()):
+            eta_txt = ""
+            if row.eta is not None:
+                # ETA ที่เลยไปวันอื่นแสดงวันที่ด้วย ไม่ให้อ่านเป็นเวลาของวันนี้
+                eta_day = "" if row.eta.date() == now.date() else f"{thai_date(row.eta.date().isoformat())} "
+                eta_txt = f" · คาดว่าเสร็จ {eta_day}{row.eta:%H:%M}"
+            col.progress(row.done / row.total, text=f"{SHIFT_LABEL_MAP[row.shift]}: เสร็จ {row.done}/{row.total}{eta_txt}")
+    rate = stats["throughput_per_hour"]
+    st.caption(
+        f"⚡ อัตราเฉลี่ย {rate:.1f} เคส/ชม. ({THROUGHPUT_WINDOW_MINUTES} นาทีล่าสุด)" if rate
+        else "⚡ ยังไม่มีข้อมูลพอคำนวณอัตราเคส/ชม."
+    )
+    current_time = dt.datetime.now()
+    year_th_cur = current_time.year + 543
+    year_short_cur = year_th_cur % 100
+    current_time_str = f"{current_time.day:02d}/{current_time.month:02d}/{year_short_cur:02d} {current_time.strftime('%H:%M:%S')}"
+    remaining_cases = stats["remaining_total"]
+    status_cols = st.columns(3)
+    with status_cols[0]:
+        st.markdown(f"<p style='text-align: left; color: black; margin-top: 20px;'><strong>⏰ เวลาปัจจุบัน:</strong> {current_time_str}</p>", unsafe_allow_html=True)
+    with status_cols[1]:
+        st.markdown(f"<p style='text-align: center; color: #666666; margin-top: 20px;'><strong>📤 อัปโหลดเมื่อ:</strong> {upload_time_str}</p>", unsafe_allow_html=True)
+    with status_cols[2]:
+        st.markdown(f"<p style='text-align: right; color: #d73a3a; font-weight: bold; margin-top: 20px;'><strong>⏳ เหลือเคสที่ยังไม่เสร็จ:</strong> {remaining_cases} ราย</p>", unsafe_allow_html=True)
+
+render_ongoing()
 small_divider(70, 2, "#eeeeee", 12)
 
 # ===============================
@@ -498,44 +344,65 @@ small_divider(70, 2, "#eeeeee", 12)
 # ===============================
 st.subheader("✅ รายการผ่าตัดวันนี้ (ไม่แสดงชื่อผู้ป่วย/ชื่อแพทย์)")
 safe_cols = []
-if "icd9cm_name" in df_raw.columns:
+if "icd9cm_name" in df_day.columns:
     safe_cols.append("icd9cm_name")
-if "procnote" in df_raw.columns:
+if "procnote" in df_day.columns:
     safe_cols.append("procnote")
 if not safe_cols:
     st.info("ไม่พบคอลัมน์ Operation/Proc note สำหรับแสดงรายการแบบไม่ระบุตัวบุคคล")
 else:
-    df_safe = df_raw.copy()
-    if "estmtime" in df_safe.columns:
-        df_safe["__est_sort__"] = df_safe["estmtime"].apply(to_minutes_from_any)
-        df_safe = df_safe.sort_values("__est_sort__", na_position="last").drop(columns="__est_sort__", errors="ignore")
-    df_safe = df_safe[safe_cols].copy().reset_index(drop=True)
-    df_safe.rename(columns={"icd9cm_name": "Operation", "procnote": "Proc note"}, inplace=True)
-    completed = st.session_state["completed_cases"]
-    header = st.columns([0.6, 3.5, 4.5, 1.4])
-    header[0].markdown("**#**")
-    header[1].markdown("**Operation**")
-    header[2].markdown("**Proc note**")
-    header[3].markdown("**สถานะ**")
-    for i, row in df_safe.iterrows():
-        c0, c1, c2, c3 = st.columns([0.6, 3.5, 4.5, 1.4])
-        c0.write(i)
-        c1.write(row.get("Operation", ""))
-        proc_note = row.get("Proc note", "")
-        c2.write("" if pd.isna(proc_note) else proc_note)
-        if i in completed:
-            c3.success("✓ เสร็จแล้ว")
-        else:
-            if c3.button("เสร็จแล้ว", key=f"done_safe_{i}"):
-                mark_completed(upload_date_str, active_file_name, i)
-                st.session_state["completed_cases"].add(i)
-                st.rerun()
-    col_reset1, col_reset2 = st.columns([6, 1.5])
-    with col_reset2:
-        if st.button("รีเซ็ตสถานะ", key="reset_completed_safe"):
-            reset_completed_cases(upload_date_str, active_file_name)
-            st.session_state["completed_cases"] = set()
+    # df_day เรียงตาม estmtime มาแล้วตอน enrich
+    df_safe = df_day[(["__room__"] if multi_room else []) + safe_cols].rename(
+        columns={"__room__": "ห้อง", "icd9cm_name": "Operation", "procnote": "Proc note"}
+    )
+    # สถานะเสร็จแล้วเก็บตาม case key (ไม่ใช่เลขแถว) อัปโหลดไฟล์แก้ไขแล้วเคสเดิมยังคงสถานะ
+    case_keys = df_day["__case_key__"].to_numpy()
+    op_dates = df_day["__op_date__"].astype(str).to_numpy()
+
+    @st.fragment(run_every=LIVE_REFRESH_SECONDS)
+    @timed("render.case_list")
+    def render_case_list(df_safe: pd.DataFrame):
+        n_cases = len(df_safe)
+        completion = sync_completed_cases(schedule_hash, selected_day, df_day)
+        pg1, pg2, pg3 = st.columns([1, 1, 4])
+        with pg1:
+            page_size = st.selectbox("เคสต่อหน้า", CASE_PAGE_SIZES, index=1, key="case_page_size")
+        n_pages = max(1, -(-n_cases // page_size))
+        with pg2:
+            page = int(st.number_input("หน้า", min_value=1, max_value=n_pages, value=1, step=1, key=f"case_page_{selected_day}"))
+        with pg3:
+            st.caption(f"ทั้งหมด {n_cases} เคส ({n_pages} หน้า) — ติ๊กช่องสถานะแล้วกดบันทึกครั้งเดียว")
+        start = (page - 1) * page_size
+        page_index = np.arange(start, min(start + page_size, n_cases))
+        page_view = df_safe.iloc[page_index]
+        page_view.insert(0, "#", page_index)
+        page_view["สถานะ"] = completion.mask[page_index]
+        if "case_editor_nonce" not in st.session_state:
+            st.session_state["case_editor_nonce"] = 0
+        with st.form("case_status_form", border=False):
+            edited = st.data_editor(
+                page_view,
+                hide_index=True,
+                disabled=[c for c in page_view.columns if c != "สถานะ"],
+                column_config={"สถานะ": st.column_config.CheckboxColumn("เสร็จแล้ว", default=False)},
+                key=f"case_editor_{page}_{page_size}_{st.session_state['case_editor_nonce']}",
+            )
+            submitted = st.form_submit_button("บันทึกสถานะ")
+        if submitted:
+            before = page_view["สถานะ"].to_numpy()
+            after = edited["สถานะ"].to_numpy(dtype=bool)
+            added, removed = page_index[after & ~before], page_index[before & ~after]
+            mark_completed_many(case_keys[added], op_dates[added])
+            unmark_completed_many(case_keys[removed])
+            st.session_state["case_editor_nonce"] += 1
             st.rerun()
+        col_reset1, col_reset2 = st.columns([6, 1.5])
+        with col_reset2:
+            if st.button("รีเซ็ตสถานะ", key="reset_completed_safe"):
+                reset_completed_cases(case_keys)
+                st.rerun()
+
+    render_case_list(df_safe)
 small_divider(70, 2, "#eeeeee", 12)
 
 # ===============================
@@ -549,14 +416,21 @@ with c2:
     fuzzy_threshold = st.slider("Fuzzy threshold", min_value=60, max_value=95, value=85, step=1)
 with c3:
     st.caption("ถ้าไม่มี rapidfuzz จะ fallback เป็น rule-based อัตโนมัติ")
-summary_df, meta, df_work = build_daily_summary(df_raw, use_fuzzy=use_fuzzy, fuzzy_threshold=fuzzy_threshold)
+if use_fuzzy and day_meta["proc_col_used"]:
+    fuzzy_cats = fuzzy_categories(df_day, fuzzy_threshold)
+    summary_df, meta = build_daily_summary(df_day, day_meta, categories=fuzzy_cats)
+else:
+    summary_df, meta = rules_summary_df, rules_meta
+classification_stats = get_classification_cache().stats()
 st.caption(
     f"proc col: {meta.get('proc_col_used') or '-'} | "
     f"time col: {meta.get('time_col_used') or '-'} | "
-    f"cases: {meta.get('cases_total')}"
+    f"cases: {meta.get('cases_total')} | "
+    f"classification cache: hit {classification_stats['hits']} / miss {classification_stats['misses']} "
+    f"({classification_stats['hit_rate']:.0%}), {classification_stats['entries']} entries"
 )
 base_cols = ["Shift", "Total"]
-active_categories = [col for col in PROC_CATEGORIES if col in summary_df.columns and (summary_df[col] > 0).any()]
+active_categories = [col for col in get_rules().categories if col in summary_df.columns and (summary_df[col] > 0).any()]
 display_cols = base_cols[:1] + active_categories + base_cols[1:]
 if not active_categories and "Other" in summary_df.columns:
     display_cols = ["Shift", "Other", "Total"]
@@ -567,17 +441,80 @@ small_divider(70, 2, "#eeeeee", 12)
 # Other review
 # ===============================
 st.subheader("🔍 Operation นอกเหนือที่ตั้งค่าไว้ (Other review)")
+if get_rules_holder().error:
+    st.warning(f"proc_rules.json มีปัญหา ใช้ rules ชุดเดิมอยู่: {get_rules_holder().error}")
 proc_col_used = meta.get("proc_col_used")
 if not proc_col_used:
     st.info("ไม่พบคอลัมน์หัตถการในไฟล์ จึงไม่สามารถทำ Other review ได้")
 else:
-    unk_df = top_unknowns(df_work, proc_col_used, n=25)
+    unk_df = top_unknowns(df_day, n=25)
     if unk_df.empty:
         st.success("ไม่มีรายการที่ตกเป็น Other")
     else:
-        st.caption("ใช้รายการนี้เพิ่ม ALIASES หรือ pattern ได้")
+        st.caption("ใช้รายการนี้เพิ่ม aliases หรือ rules ใน proc_rules.json ได้ (โหลดใหม่อัตโนมัติเมื่อไฟล์เปลี่ยน)")
         df_show(unk_df, stretch=True)
 small_divider(70, 2, "#eeeeee", 12)
+
+# ===============================
+# ดาวน์โหลดรายงาน (สร้างเบื้องหลัง ใช้ไฟล์เดียวกันทุก session จนกว่าสถานะ/ไฟล์จะเปลี่ยน)
+# ===============================
+st.subheader("📥 ดาวน์โหลดรายงาน")
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+@timed("render.exports")
+def render_exports():
+    # rerun เต็มใช้ job ที่สั่งไว้ตอนต้นหน้า ส่วนรอบ refresh ของ fragment sync สถานะใหม่เอง
+    jobs = st.session_state.pop("prefetched_exports", None)
+    if jobs is None:
+        completion = sync_completed_cases(schedule_hash, selected_day, df_day)
+        jobs = request_exports(schedule_hash, selected_day, df_day, day_meta, completion)
+    export_cols = st.columns(len(jobs))
+    # ไฟล์ใหม่ส่วนใหญ่เสร็จในไม่กี่ร้อย ms รอสั้นๆ (รวมทุกรูปแบบ) ถ้ายังไม่เสร็จแสดงในรอบ refresh ถัดไป
+    deadline = time.perf_counter() + EXPORT_WAIT_SECONDS
+    for col, (fmt, job) in zip(export_cols, jobs.items()):
+        label, ext, mime = EXPORT_FORMATS[fmt]
+        job.wait(max(0.0, deadline - time.perf_counter()))
+        if job.state == "ready":
+            col.download_button(label, job.data, file_name=f"or_minor_{selected_day}.{ext}", mime=mime, key=f"export_{fmt}")
+        elif job.state == "failed":
+            col.error(f"{label}: {job.error}")
+        else:
+            col.button(f"{label} (กำลังเตรียมไฟล์)", disabled=True, key=f"export_{fmt}_pending")
+    st.caption("รายงานของวันที่เลือก: สรุปเช้า/บ่าย/TF, รายการเคสพร้อมสถานะและเวลาที่เสร็จ (ไม่มีชื่อผู้ป่วย/แพทย์), Other review")
+
+render_exports()
+small_divider(70, 2, "#eeeeee", 12)
+
+# ===============================
+# ประวัติย้อนหลัง (จาก daily_rollups)
+# ===============================
+st.subheader("🗂️ ประวัติย้อนหลัง (รายเดือน/รายปี)")
+first_day, last_day = rollup_date_range()
+if not first_day:
+    st.info("ยังไม่มีข้อมูลในคลังย้อนหลัง")
+else:
+    h1, h2 = st.columns([2, 1])
+    with h1:
+        history_range = st.date_input(
+            "ช่วงวันที่ผ่าตัด",
+            # ทั้งปีปฏิทิน: ค่า default ไม่เปลี่ยนทุกครั้งที่มีวันใหม่เข้าคลัง (widget จำค่าที่เลือกไว้)
+            value=(dt.date(int(first_day[:4]), 1, 1), dt.date(int(last_day[:4]), 12, 31)),
+            key="history_range",
+        )
+    with h2:
+        history_by = st.radio("สรุปตาม", ["month", "year"], format_func={"month": "เดือน", "year": "ปี"}.get,
+                              horizontal=True, key="history_by")
+    if len(history_range) == 2:
+        history_df = history_summary(history_range[0].isoformat(), history_range[1].isoformat(), by=history_by)
+        if history_df.empty:
+            st.info("ไม่มีเคสในช่วงวันที่ที่เลือก")
+        else:
+            df_show(history_df, stretch=True)
+            st.bar_chart(history_df.set_index("period").drop(columns="Total"))
+small_divider(70, 2, "#eeeeee", 12)
 st.caption("Dashboard พร้อมใช้งานเต็มรูปแบบ! ไฟล์ Excel และสถานะเสร็จแล้วเป็น shared ทุกคนเห็นเหมือนกัน")
 
+timings.record("script.rerun", time.perf_counter() - rerun_t0)
+if PROMETHEUS_TEXTFILE:
+    timings.export_prometheus(PROMETHEUS_TEXTFILE, cache_stats())
+
 